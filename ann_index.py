@@ -0,0 +1,219 @@
+import numpy as np
+import time
+
+from knn_utils import DUPLICATE_THRESHOLD, KNNIndex
+
+def kmeans(data,nb_clusters,nb_iter=20,seed=1234):
+    # plain Lloyd iterations; distances come from one GEMM per iteration
+    rng=np.random.RandomState(seed)
+    nb_clusters=min(nb_clusters,len(data))
+    centroids=data[rng.choice(len(data),nb_clusters,replace=False)].copy()
+    data_norms=np.einsum('ij,ij->i',data,data)
+    for it in range(nb_iter):
+        assign=assign_clusters(data,centroids,data_norms)
+        for c in range(nb_clusters):
+            members=data[assign==c]
+            if len(members):
+                centroids[c]=members.mean(axis=0)
+            else:
+                #re-seed empty clusters on a random point
+                centroids[c]=data[rng.randint(len(data))]
+    return centroids
+
+def assign_clusters(data,centroids,data_norms=None,block_size=8192):
+    if data_norms is None:
+        data_norms=np.einsum('ij,ij->i',data,data)
+    centroid_norms=np.einsum('ij,ij->i',centroids,centroids)
+    assign=np.empty(len(data),dtype=np.int64)
+    for start in range(0,len(data),block_size):
+        end=min(len(data),start+block_size)
+        dst=data_norms[start:end,None]+centroid_norms[None,:]-2.*np.dot(data[start:end],centroids.T)
+        assign[start:end]=dst.argmin(axis=1)
+    return assign
+
+class IVFPQIndex(object):
+    """
+    Approximate nearest neighbour index (inverted file + product quantization)
+    over the corpus image features.
+
+    The corpus is split into `nb_lists` coarse k-means cells; the residual of every
+    feature to its cell centroid is encoded with `nb_subquantizers` one-byte codes.
+    A query only visits the `nprobe` closest cells, ranks their codes with
+    per-query lookup tables and re-scores the best `rerank` candidates exactly
+    against `features_struct`, so the returned distances are exact and search()
+    is a drop-in replacement for KNNIndex.search().
+
+    Arguments
+    ---------
+    nb_lists: number of inverted lists (coarse centroids)
+    nb_subquantizers: number of PQ sub-vectors; has to divide the feature dim
+    nb_codes: centroids per sub-quantizer (<= 256)
+    nprobe: default number of inverted lists visited per query
+    rerank: number of PQ candidates re-scored exactly per query
+    metric: 'euclidean' or 'cosine'
+    """
+    def __init__(self,nb_lists=1024,nb_subquantizers=64,nb_codes=256,nprobe=16,rerank=256,metric='euclidean'):
+        if nb_codes>256:
+            raise Exception('nb_codes has to fit in one byte: '+str(nb_codes))
+        if metric not in ('euclidean','cosine'):
+            raise Exception('Invalid metric: '+str(metric))
+        self.nb_lists=nb_lists
+        self.nb_subquantizers=nb_subquantizers
+        self.nb_codes=nb_codes
+        self.nprobe=nprobe
+        self.rerank=rerank
+        self.metric=metric
+        self.features=None
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    def _prepare(self,data):
+        data=np.asarray(data,dtype=np.float32)
+        if self.metric=='cosine':
+            norms=np.sqrt(np.einsum('ij,ij->i',data,data))
+            norms[norms==0]=1.
+            data=data/norms[:,None]
+        return data
+
+    def _split(self,data):
+        return data.reshape(len(data),self.nb_subquantizers,-1)
+
+    def train(self,features_struct,nb_train=50000,nb_iter=20,seed=1234):
+        data=self._prepare(features_struct)
+        if data.shape[1]%self.nb_subquantizers!=0:
+            raise Exception('Feature dim %d is not divisible by nb_subquantizers %d' % (data.shape[1],self.nb_subquantizers))
+        rng=np.random.RandomState(seed)
+        sample=data
+        if len(data)>nb_train:
+            sample=data[rng.choice(len(data),nb_train,replace=False)]
+        self.centroids=kmeans(sample,self.nb_lists,nb_iter=nb_iter,seed=seed)
+        self.nb_lists=len(self.centroids)
+        residuals=self._split(sample-self.centroids[assign_clusters(sample,self.centroids)])
+        codebooks=[]
+        for j in range(self.nb_subquantizers):
+            codebooks.append(kmeans(np.ascontiguousarray(residuals[:,j]),self.nb_codes,nb_iter=nb_iter,seed=seed+j))
+        self.nb_codes=min(len(codebook) for codebook in codebooks)
+        self.codebooks=np.array([codebook[:self.nb_codes] for codebook in codebooks],dtype=np.float32)
+        self.add(features_struct)
+
+    def add(self,features_struct,block_size=8192):
+        # encode the whole corpus; inverted lists are stored CSR style (list_offsets, list_ids)
+        data=self._prepare(features_struct)
+        assign=assign_clusters(data,self.centroids)
+        codes=np.empty((len(data),self.nb_subquantizers),dtype=np.uint8)
+        codebook_norms=np.einsum('jkd,jkd->jk',self.codebooks,self.codebooks)
+        for start in range(0,len(data),block_size):
+            end=min(len(data),start+block_size)
+            residuals=self._split(data[start:end]-self.centroids[assign[start:end]])
+            for j in range(self.nb_subquantizers):
+                dst=codebook_norms[j][None,:]-2.*np.dot(residuals[:,j],self.codebooks[j].T)
+                codes[start:end,j]=dst.argmin(axis=1)
+        order=np.argsort(assign,kind='mergesort')
+        self.list_ids=order
+        self.codes=codes[order]
+        self.list_offsets=np.concatenate([[0],np.cumsum(np.bincount(assign,minlength=self.nb_lists))])
+        self.attach(features_struct)
+
+    def attach(self,features_struct):
+        # exact re-scoring of the shortlist needs the raw features
+        self.exact=KNNIndex(features_struct,metric=self.metric)
+        self.features=features_struct
+
+    def _probe(self,query,nprobe):
+        dst=((self.centroids-query)**2).sum(axis=1)
+        nprobe=min(nprobe,self.nb_lists)
+        lists=np.argpartition(dst,nprobe-1)[:nprobe]
+        ids=[]
+        pq_dst=[]
+        for l in lists:
+            start,end=self.list_offsets[l],self.list_offsets[l+1]
+            if start==end:
+                continue
+            residual=self._split((query-self.centroids[l])[None,:])[0]
+            tables=((self.codebooks-residual[:,None,:])**2).sum(axis=2)
+            pq_dst.append(tables[np.arange(self.nb_subquantizers)[None,:],self.codes[start:end]].sum(axis=1))
+            ids.append(self.list_ids[start:end])
+        if len(ids)==0:
+            return np.zeros(0,dtype=np.int64),np.zeros(0)
+        return np.concatenate(ids),np.concatenate(pq_dst)
+
+    def search(self,queries,k,exclude=None,min_distance=DUPLICATE_THRESHOLD,nprobe=None):
+        """
+        Same contract as KNNIndex.search(): (indices, distances) sorted by
+        increasing exact distance, padded with -1/inf.
+        """
+        if self.features is None:
+            raise Exception('IVFPQIndex has no features attached; call attach(features_struct) after load().')
+        if nprobe is None:
+            nprobe=self.nprobe
+        queries=np.atleast_2d(queries)
+        prepared=self._prepare(queries)
+        k=min(k,len(self))
+        indices=np.empty((len(queries),k),dtype=np.int64)
+        indices.fill(-1)
+        distances=np.empty((len(queries),k))
+        distances.fill(np.inf)
+        for q in range(len(queries)):
+            ids,pq_dst=self._probe(prepared[q],nprobe)
+            if exclude is not None and len(ids):
+                keep=~exclude[ids]
+                ids,pq_dst=ids[keep],pq_dst[keep]
+            shortlist=max(self.rerank,k)
+            if len(ids)>shortlist:
+                part=np.argpartition(pq_dst,shortlist-1)[:shortlist]
+                ids=ids[part]
+            if len(ids)==0:
+                continue
+            exact=self.exact.exact_distances(queries[q],ids)
+            if min_distance is not None:
+                keep=exact>=min_distance
+                ids,exact=ids[keep],exact[keep]
+            order=np.lexsort((ids,exact))[:k]
+            indices[q,:len(order)]=ids[order]
+            distances[q,:len(order)]=exact[order]
+        return indices,distances
+
+    def save(self,path):
+        np.savez(path,centroids=self.centroids,codebooks=self.codebooks,codes=self.codes,
+            list_ids=self.list_ids,list_offsets=self.list_offsets,
+            params=np.array([self.nb_lists,self.nb_subquantizers,self.nb_codes,self.nprobe,self.rerank]),
+            metric=np.array(self.metric))
+
+    @classmethod
+    def load(cls,path,features_struct=None):
+        data=np.load(path)
+        nb_lists,nb_subquantizers,nb_codes,nprobe,rerank=[int(p) for p in data['params']]
+        index=cls(nb_lists=nb_lists,nb_subquantizers=nb_subquantizers,nb_codes=nb_codes,
+            nprobe=nprobe,rerank=rerank,metric=str(data['metric']))
+        index.centroids=data['centroids']
+        index.codebooks=data['codebooks']
+        index.codes=data['codes']
+        index.list_ids=data['list_ids']
+        index.list_offsets=data['list_offsets']
+        if features_struct is not None:
+            if len(features_struct)!=len(index.list_ids):
+                raise Exception('ANN index was built on %d images, features have %d.' % (len(index.list_ids),len(features_struct)))
+            index.attach(features_struct)
+        return index
+
+def recall_at_k(ann_index,queries,k,nprobe_list=(1,4,16,64),exclude=None):
+    """
+    Recall@k of the ANN index against exact search, with the mean query latency
+    for each nprobe. Returns [(nprobe, recall, seconds per query), ..].
+    """
+    queries=np.atleast_2d(queries)
+    exact_ids,_=ann_index.exact.search(queries,k,exclude=exclude)
+    report=[]
+    for nprobe in nprobe_list:
+        start=time.time()
+        ann_ids,_=ann_index.search(queries,k,exclude=exclude,nprobe=nprobe)
+        elapsed=(time.time()-start)/len(queries)
+        hits=0
+        total=0
+        for exact_row,ann_row in zip(exact_ids,ann_ids):
+            exact_row=set(exact_row[exact_row>=0])
+            hits+=len(exact_row.intersection(ann_row[ann_row>=0]))
+            total+=len(exact_row)
+        report.append((nprobe,hits/float(max(total,1)),elapsed))
+    return report
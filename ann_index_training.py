@@ -0,0 +1,23 @@
+import os
+import numpy as np
+from feature_store import *
+from ann_index import *
+
+features_path = resolve_features_path(os.path.join('./data/', 'example.mat'))
+features_struct = load_features(features_path)
+
+ANN_INDEX_PATH='./model/example.ivfpq.npz'
+TOPK=3
+
+nb_lists=int(np.sqrt(len(features_struct)))*4 #rule of thumb for IVF
+index = IVFPQIndex(nb_lists=nb_lists,nb_subquantizers=64,nb_codes=256,nprobe=16,rerank=256)
+print "training ann index on", len(features_struct), "images"
+index.train(features_struct)
+index.save(ANN_INDEX_PATH)
+print "ann index saved"
+
+#recall report against exact search on held-in queries
+rng=np.random.RandomState(1)
+queries=features_struct[rng.choice(len(features_struct),min(200,len(features_struct)),replace=False)]
+for nprobe,recall,latency in recall_at_k(index,queries,TOPK,nprobe_list=(1,4,16,64)):
+    print "nprobe %d recall@%d %.4f %.2f ms/query" % (nprobe,TOPK,recall,latency*1000)
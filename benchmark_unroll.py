@@ -0,0 +1,45 @@
+#compares scan and unrolled (unroll=True) recurrent layers on random data:
+#training and scoring throughput of the CRCN models at sequence lengths 5, 10 and 15
+#python benchmark_unroll.py [batch_size] [repeats]
+import sys
+sys.path.append("./keras")
+import time
+import numpy as np
+from load_models import *
+
+numbers=[int(arg) for arg in sys.argv[1:] if arg.isdigit()]
+batch_size=100
+repeats=5
+if len(numbers)>0:
+    batch_size=numbers[0]
+if len(numbers)>1:
+    repeats=numbers[1]
+SEQ_LENGTHS=[5,10,15]
+MODELS=[('crcn_blstm',create_crcn_blstm),('crcn_brnn',create_crcn)]
+
+def throughput(fn,nb_samples):
+    fn() #first call allocates
+    start=time.time()
+    for i in range(repeats):
+        fn()
+    return nb_samples*repeats/(time.time()-start)
+
+rng=np.random.RandomState(1234)
+results=[]
+for model_name,create_model in MODELS:
+    for seq_len in SEQ_LENGTHS:
+        #sentence vectors with the entity vector last, image features
+        X=rng.randn(batch_size,seq_len+1,300).astype('float32')
+        y=rng.randn(batch_size,seq_len,4096).astype('float32')
+        for unroll in [False,True]:
+            model=create_model(unroll=unroll,max_length=seq_len)
+            start=time.time()
+            model.compile(loss='crcn_cost_func',optimizer='rmsprop',score='crcn_score_vec_func')
+            compile_time=time.time()-start
+            train=throughput(lambda: model.train(X,y),batch_size)
+            score=throughput(lambda: model.score_samples(X,y,batch_size),batch_size)
+            results.append((model_name,seq_len,'unroll' if unroll else 'scan',compile_time,train,score))
+
+print '%-12s %5s %7s %12s %16s %16s' % ('model','len','mode','compile (s)','train (seq/s)','score (seq/s)')
+for result in results:
+    print '%-12s %5d %7s %12.1f %16.1f %16.1f' % result
@@ -0,0 +1,93 @@
+import numpy as np
+
+class DocVecMatrix(object):
+    """
+    Dense float32 copy of the doc2vec paragraph vectors with an imgid -> row index.
+
+    Candidate sentence tensors are gathered with one np.take over an int index
+    array instead of one string conversion and gensim lookup per element.
+    Also indexable like the doc2vec model (docvecs[str(imgid)]).
+
+    Arguments
+    ---------
+    vectors: (nb_rows, dim) matrix
+    row_of: int array indexed by imgid, -1 where the image has no paragraph vector
+    """
+    def __init__(self,vectors,row_of):
+        self.vectors=np.ascontiguousarray(vectors,dtype=np.float32)
+        self.row_of=np.asarray(row_of,dtype=np.int64)
+        self.valid=self.row_of>=0 #imgid -> has paragraph vector
+
+    @classmethod
+    def from_doc2vec(cls,doc2vecmodel,imgids):
+        # one-time export; images without a paragraph vector are marked invalid
+        row_of=np.empty(max(imgids)+1,dtype=np.int64)
+        row_of.fill(-1)
+        vectors=[]
+        for imgid in imgids:
+            try:
+                vector=doc2vecmodel[str(imgid)]
+            except:
+                continue
+            row_of[imgid]=len(vectors)
+            vectors.append(vector)
+        return cls(np.array(vectors),row_of)
+
+    def matches(self,imgids):
+        # an export is reusable for a corpus when it is indexed by the same imgids
+        imgids=np.asarray(imgids,dtype=np.int64)
+        if len(imgids)==0 or len(self.row_of)!=imgids.max()+1:
+            return False
+        corpus=np.zeros(len(self.row_of),dtype=bool)
+        corpus[imgids]=True
+        return not (self.valid&~corpus).any()
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def has(self,imgid):
+        return 0<=imgid<len(self.row_of) and bool(self.valid[imgid])
+
+    def rows(self,imgids):
+        imgids=np.asarray(imgids,dtype=np.int64)
+        if imgids.size and (imgids.max()>=len(self.row_of) or not self.valid[imgids].all()):
+            raise KeyError('imgid without paragraph vector')
+        return self.row_of[imgids]
+
+    def __getitem__(self,key):
+        imgid=int(key)
+        if not self.has(imgid):
+            raise KeyError(key)
+        return self.vectors[self.row_of[imgid]]
+
+    def take(self,key_seq_list):
+        # (caselen, content_len) imgids -> (caselen, content_len, dim) in one gather
+        return np.take(self.vectors,self.rows(key_seq_list),axis=0)
+
+    def project(self,projection):
+        # same index, vectors mapped through projection (e.g. BLSTM.project_inputs)
+        return DocVecMatrix(projection(self.vectors),self.row_of)
+
+    def save(self,path):
+        np.savez(path,vectors=self.vectors,row_of=self.row_of)
+
+    @classmethod
+    def load(cls,path):
+        data=np.load(path)
+        return cls(data['vectors'],data['row_of'])
+
+_docvec_matrix_cache={}
+
+def as_docvec_matrix(doc2vecmodel,json_imgs):
+    # exports a gensim model once per process; a DocVecMatrix is returned as is
+    if isinstance(doc2vecmodel,DocVecMatrix):
+        return doc2vecmodel
+    key=id(doc2vecmodel)
+    if key in _docvec_matrix_cache and _docvec_matrix_cache[key][0] is doc2vecmodel:
+        return _docvec_matrix_cache[key][1]
+    docvecs=DocVecMatrix.from_doc2vec(doc2vecmodel,[json_img['imgid'] for json_img in json_imgs])
+    _docvec_matrix_cache[key]=(doc2vecmodel,docvecs)
+    return docvecs
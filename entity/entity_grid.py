@@ -6,6 +6,7 @@ from os.path import join, isfile, splitext
 import math
 import pandas as pd
 import itertools
+import copy
 def print_full(x):
     pd.set_option('display.max_rows', len(x))
     print(x)
@@ -335,3 +336,217 @@ class EntityGrid:
     def print_grids(self):
         for grid in self.grids:
             print grid
+
+
+# Integer codes of the roles: the position of each role in the sorted role
+# set, so a transition read as a base-len(role set) number is its index in
+# generate_transitions(). -1 marks a role outside the role set.
+_syntax_role_codes = {'-': 0, 'O': 1, 'S': 2, 'X': 3}
+_plain_role_codes = {'-': 0, 'X': 1}
+
+
+class RoleGrid:
+
+    def __init__(self, entities, roles, saliences, syntax=True):
+        """Compact entity grid: an int8 role matrix (entities x sentences)
+            from which transition vectors are counted with numpy.
+            Gives the same vectors as EntityGrid without pandas."""
+
+        self.entities = entities
+        self.roles = roles
+        # Number of sentences in which each entity has a role other than '-'.
+        self.saliences = saliences
+        self.syntax = syntax
+
+    @classmethod
+    def from_string(cls, grid_str, syntax=True):
+        """Parses output of TestGrid, like parse_grid_string."""
+
+        codes = _syntax_role_codes if syntax is True else _plain_role_codes
+        entities = []
+        rows = []
+        for line in grid_str.strip().split("\n"):
+            if (line.strip() is not ""):
+                cells = line.strip().split(" ")
+                entities.append(cells[0].decode("ascii", "ignore"))
+                rows.append([cell.upper() for cell in cells[1:]])
+        nb_sentences = max([len(row) for row in rows] + [0])
+        roles = np.empty((len(rows), nb_sentences), dtype=np.int8)
+        roles.fill(-1)
+        saliences = np.zeros(len(rows), dtype=np.int64)
+        for e, row in enumerate(rows):
+            roles[e, :len(row)] = [codes.get(cell, -1) for cell in row]
+            saliences[e] = sum(1 for cell in row if cell != '-')
+        return cls(entities, roles, saliences, syntax)
+
+    def to_dataframe(self):
+        """The same DataFrame as parse_grid_string, for debugging."""
+
+        role_set = sorted(self._role_codes())
+        grid = [[role_set[r] if r >= 0 else '?' for r in row]
+                for row in self.roles]
+        return pd.DataFrame(grid, index=self.entities)
+
+    def _count_transitions(self, roles, history):
+        """Counts the transitions of length history, as integer codes."""
+
+        return count_transitions_batch(roles[None], history, len(self._role_codes()))[0]
+
+    def _role_codes(self):
+        return _syntax_role_codes if self.syntax is True else _plain_role_codes
+
+    def _salience_levels(self, max_salience):
+        # Same levels, in the same order, as _split_grid_by_salience.
+        saliences = np.minimum(self.saliences, max_salience)
+        levels = sorted(set(range(1, max_salience+1)) | set(saliences.tolist()))
+        return saliences, levels
+
+    def get_trans_cnt_vctr(self, history=2, max_salience=2):
+        """Get a vector of entity transition counts."""
+
+        saliences, levels = self._salience_levels(max_salience)
+        return np.concatenate([self._count_transitions(self.roles[saliences == s], history)
+                               for s in levels])
+
+    def get_trans_prob_vctr(self, history=2, max_salience=2):
+        """Get a vector of entity transition probabilities."""
+
+        saliences, levels = self._salience_levels(max_salience)
+        v = []
+        for s in levels:
+            counts = self._count_transitions(self.roles[saliences == s], history)
+            total = counts.sum()
+            if total > 0:
+                counts /= total
+            v.append(counts)
+        return np.concatenate(v)
+
+    def get_permutation_trans_prob_vctrs(self, indices, history=2,
+                                         max_salience=2):
+        """Transition probability vectors of many sentence orderings at once.
+            indices is an (n_perms x n_sentences) array of 0-based sentence
+            indices; row i gives the same vector as
+            get_partial_grid(indices[i]).get_trans_prob_vctr() of the
+            pandas EntityGrid (salience comes from the whole document)."""
+
+        indices = np.atleast_2d(np.asarray(indices, dtype=np.int64))
+        saliences, levels = self._salience_levels(max_salience)
+        # (n_perms, entities, n_sentences)
+        permuted = self.roles[:, indices].transpose(1, 0, 2)
+        v = []
+        for s in levels:
+            counts = count_transitions_batch(permuted[:, saliences == s],
+                                             history, len(self._role_codes()))
+            totals = counts.sum(axis=1)
+            totals[totals == 0] = 1.
+            v.append(counts / totals[:, None])
+        return np.concatenate(v, axis=1)
+
+
+def count_transitions_batch(roles, history, base=4):
+    """Transition counts of a batch of grids: (grids, entities, sentences)
+        role codes, -1 for no/unknown role -> (grids, base**history).
+        Only transitions of exactly history roles are counted, as in
+        EntityGrid._count_transitions."""
+
+    nb_grids = roles.shape[0]
+    nb_trans = base ** history
+    nb_windows = roles.shape[2] - history + 1
+    if history < 2 or roles.shape[1] == 0 or nb_windows <= 0:
+        return np.zeros((nb_grids, nb_trans))
+    codes = np.zeros(roles.shape[:2] + (nb_windows,), dtype=np.int64)
+    valid = np.ones(codes.shape, dtype=bool)
+    for k in range(history):
+        window = roles[:, :, k:k+nb_windows]
+        codes = codes*base + window
+        valid &= window >= 0
+    grid_index = np.broadcast_to(np.arange(nb_grids)[:, None, None], codes.shape)
+    counts = np.bincount((grid_index*nb_trans + codes)[valid],
+                         minlength=nb_grids*nb_trans)
+    return counts.reshape(nb_grids, nb_trans).astype(float)
+
+
+def grid_string_to_trans_prob_vector(grid_str, history=2, syntax=True,
+                                     max_salience=0):
+    """Fast path for
+        new_entity_grid(grid_str, syntax, max_salience, history).get_trans_prob_vctr()."""
+
+    return RoleGrid.from_string(grid_str, syntax).get_trans_prob_vctr(history, max_salience)
+
+
+def grid_string_to_permutation_trans_prob_matrix(grid_str, indices, history=2,
+                                                 syntax=True, max_salience=0):
+    """(n_perms x n_sentences) sentence orderings of one TestGrid grid ->
+        (n_perms x len(trans)) transition probability matrix."""
+
+    return RoleGrid.from_string(grid_str, syntax).get_permutation_trans_prob_vctrs(indices, history, max_salience)
+
+
+class EntityTransitionState:
+
+    def __init__(self, history=3, syntax=True):
+        """Running transition counts of a document grown one sentence at a
+            time. Every entity keeps the code of its last history-1 roles,
+            so append() costs O(entities) and the vector after each append
+            is the one of the whole prefix grid (max_salience=0)."""
+
+        self.history = history
+        self.syntax = syntax
+        self.role_codes = (_syntax_role_codes if syntax is True
+                           else _plain_role_codes)
+        self.base = len(self.role_codes)
+        self.nb_sentences = 0
+        self.entity_index = {}
+        # Suffix code per entity, roles outside the role set read as '-'.
+        self.suffixes = np.zeros(0, dtype=np.int64)
+        # Appends left before a role outside the role set leaves the suffix.
+        self.invalid = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(self.base ** history)
+
+    def copy(self):
+        state = copy.copy(self)
+        state.entity_index = dict(self.entity_index)
+        state.suffixes = self.suffixes.copy()
+        state.invalid = self.invalid.copy()
+        state.counts = self.counts.copy()
+        return state
+
+    def append(self, column):
+        """Add the next sentence: column is [(entity, role), ..] or
+            {entity: role}, as sentence_roles() returns."""
+
+        column = dict(column)
+        new_entities = [e for e in column if e not in self.entity_index]
+        if len(new_entities):
+            for e in new_entities:
+                self.entity_index[e] = len(self.entity_index)
+            # An entity seen for the first time has had '-' in every earlier
+            # sentence, so its all '-' transitions are added retroactively.
+            if self.history >= 2:
+                self.counts[0] += len(new_entities) * max(0, self.nb_sentences - self.history + 1)
+            self.suffixes = np.concatenate([self.suffixes, np.zeros(len(new_entities), dtype=np.int64)])
+            self.invalid = np.concatenate([self.invalid, np.zeros(len(new_entities), dtype=np.int64)])
+        roles = np.zeros(len(self.entity_index), dtype=np.int64)
+        for e, role in column.iteritems():
+            roles[self.entity_index[e]] = self.role_codes.get(role.upper(), -1)
+        codes = self.suffixes * self.base + np.maximum(roles, 0)
+        self.nb_sentences += 1
+        if self.history >= 2 and self.nb_sentences >= self.history:
+            valid = (self.invalid == 0) & (roles >= 0)
+            self.counts += np.bincount(codes[valid], minlength=len(self.counts))
+        self.suffixes = codes % (self.base ** (self.history - 1))
+        self.invalid = np.where(roles < 0, self.history - 1, np.maximum(self.invalid - 1, 0))
+        return self
+
+    def get_trans_cnt_vctr(self):
+        """Get a vector of entity transition counts."""
+
+        return self.counts.copy()
+
+    def get_trans_prob_vctr(self):
+        """Get a vector of entity transition probabilities."""
+
+        total = self.counts.sum()
+        if total > 0:
+            return self.counts / total
+        return np.zeros(len(self.counts))
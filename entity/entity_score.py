@@ -1,9 +1,13 @@
 #import entity_grid
 from entity_grid import *
 from parsetree import *
+from tree_grid import *
 import pickle
 import os
 import re
+import hashlib
+import atexit
+from collections import OrderedDict
 from operator import itemgetter
 import numpy as np
 # from easydict import EDict as edict
@@ -20,6 +24,145 @@ args['grammar']="./stanford-parser/stanford-parser-3.5.2-models/edu/stanford/nlp
 args['threads']=2
 args['max_length']=1000
 testgrid_path="./browncoherence/bin64/TestGrid"
+grid_backend='testgrid' # 'python' builds grids in-process (tree_grid.py), not yet shown to match TestGrid, see test_tree_grid.py
+ENTITY_FEATURE_DIM=64
+PARALLEL_GRID_MIN=256 # smaller batches are built in-process, the pool round trip costs more
+ENTITY_CACHE_SIZE=100000
+ENTITY_CACHE_FLUSH=1024 # new vectors per cache_dir shard, written in one file
+
+def tree_digest(trees):
+    if isinstance(trees,unicode):
+        trees=trees.encode('utf-8')
+    return hashlib.sha1(trees).hexdigest()
+
+def feature_digest(trees):
+    # the vector of a document depends on the grid builder as well as its trees
+    return tree_digest('%s history=3 dim=%d\n' % (grid_backend,ENTITY_FEATURE_DIM)+trees)
+
+class EntityFeatureCache(object):
+    '''
+        LRU memo of entity_feature vectors, so candidate documents repeated across
+        the chunk/merge/rerank stages and across test streams run TestGrid once.
+        Memory entries are keyed by the caller's key (e.g. the ordered imgid tuple)
+        or the feature_digest of the tree text; the optional cache_dir keeps the
+        vectors by feature_digest, which covers grid_backend, so it stays valid
+        across runs and datasets. New vectors are buffered and written flush_size
+        at a time as one .npz shard, the rest on flush() or at exit.
+    '''
+    def __init__(self,maxsize=ENTITY_CACHE_SIZE,cache_dir=None,flush_size=ENTITY_CACHE_FLUSH):
+        self.maxsize=maxsize
+        self.cache_dir=cache_dir
+        self.flush_size=flush_size
+        self.entries=OrderedDict()
+        self.pending=OrderedDict() #digest -> vector not yet on disk
+        self.shards={} #digest -> shard path
+        self.shard_files={} #shard path -> open np.load of the shard
+        self.hits=0
+        self.disk_hits=0
+        self.misses=0
+        if cache_dir is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            for name in sorted(os.listdir(cache_dir)):
+                if name.endswith('.npz'):
+                    self._open_shard(os.path.join(cache_dir,name))
+
+    def _open_shard(self,path):
+        # kept open, a disk hit then reads one member instead of reparsing the zip
+        shard=np.load(path)
+        self.shard_files[path]=shard
+        for digest in shard.files:
+            self.shards[digest]=path
+
+    def _load(self,digest):
+        if digest in self.pending:
+            return self.pending[digest]
+        if digest in self.shards:
+            return self.shard_files[self.shards[digest]][digest]
+        return None
+
+    def get(self,key,digest=None):
+        if key in self.entries:
+            vec=self.entries.pop(key)
+            self.entries[key]=vec #most recently used
+            self.hits+=1
+            return vec
+        if self.cache_dir is not None and digest is not None:
+            vec=self._load(digest)
+            if vec is not None:
+                self._remember(key,vec)
+                self.disk_hits+=1
+                return vec
+        self.misses+=1
+        return None
+
+    def put(self,key,vec,digest=None):
+        self._remember(key,vec)
+        if self.cache_dir is not None and digest is not None and digest not in self.shards:
+            self.pending[digest]=vec
+            if len(self.pending)>=self.flush_size:
+                self.flush()
+
+    def flush(self):
+        if self.cache_dir is None or len(self.pending)==0:
+            return
+        #write then rename, concurrent runs never read a partial shard
+        path=os.path.join(self.cache_dir,tree_digest(''.join(self.pending.keys()))+'.npz')
+        tmp_path='%s.%d.tmp' % (path,os.getpid())
+        with open(tmp_path,'wb') as f:
+            np.savez(f,**self.pending)
+        os.rename(tmp_path,path)
+        self.pending.clear()
+        self._open_shard(path)
+
+    def close(self):
+        self.flush()
+        for shard in self.shard_files.itervalues():
+            shard.close()
+        self.shard_files.clear()
+        self.shards.clear()
+
+    def _remember(self,key,vec):
+        self.entries.pop(key,None)
+        self.entries[key]=vec
+        while len(self.entries)>self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits=0
+        self.disk_hits=0
+        self.misses=0
+
+    def stats(self):
+        return {'hits':self.hits,'disk_hits':self.disk_hits,'misses':self.misses,'size':len(self.entries),'pending':len(self.pending)}
+
+entity_feature_cache=EntityFeatureCache()
+
+def set_entity_feature_cache(maxsize=ENTITY_CACHE_SIZE,cache_dir=None):
+    # maxsize=0 without cache_dir turns memoization off
+    global entity_feature_cache
+    entity_feature_cache.close()
+    entity_feature_cache=EntityFeatureCache(maxsize,cache_dir)
+    return entity_feature_cache
+
+def _flush_entity_feature_cache():
+    entity_feature_cache.flush()
+
+# one exit hook for whichever cache is current
+atexit.register(_flush_entity_feature_cache)
+
+def get_grids(trees_key_list):
+    global args
+    global testgrid_path
+    if grid_backend=='python':
+        if args['jobs']>1 and len(trees_key_list)>=PARALLEL_GRID_MIN:
+            return pool_manager.map(make_grid_python,trees_key_list,args['jobs'])
+        return get_grids_python(trees_key_list)
+    elif grid_backend=='testgrid':
+        return get_grids_multi_documents(testgrid_path,trees_key_list,args['jobs'])
+    else:
+        raise Exception('Invalid grid_backend: '+str(grid_backend))
 
 def entity_score(content_list,weights_path):
 
@@ -34,13 +177,12 @@ def entity_score(content_list,weights_path):
     for trees, key in itertools.izip(trees_list, uniq_list):
         if trees is not None:
             trees_key_list.append({'trees':trees,'key':str(key)})
-    grids=get_grids_multi_documents(testgrid_path,trees_key_list,args['jobs'])
+    grids=get_grids(trees_key_list)
     dict_score={}
     for grid, trees_and_key  in itertools.izip(grids, trees_key_list):
         if grid and grid.strip()!="":
-            model=new_entity_grid(grid, syntax=True,max_salience=0, history=2)
             key=int(trees_and_key['key'])
-            score=np.dot(ntsb_weights,model.get_trans_prob_vctr())
+            score=np.dot(ntsb_weights,grid_string_to_trans_prob_vector(grid,history=2,syntax=True))
             dict_score[key]=score
         else:
             dict_score[key]=0
@@ -53,10 +195,8 @@ def entity_score(content_list,weights_path):
     return sorted(dict_score.iteritems(), key=itemgetter(1), reverse=True)
 
 
-def entity_feature(trees_list):
-
-    # input content_list ["This is cspark code paragraph1", "2"...]
-    # output sorted (key,score) pair list [(key,score), ..]
+def _entity_feature_grids(trees_list):
+    # runs TestGrid on every non empty document, returns {index: 64-d vector}
     global args
     global testgrid_path
     uniq_list=range(0,len(trees_list)) #for multiple process
@@ -64,22 +204,51 @@ def entity_feature(trees_list):
     for trees, key in itertools.izip(trees_list, uniq_list):
         if len(trees.strip())!=0:
             trees_key_list.append({'trees':trees.encode('ascii','ignore'),'key':str(key)})
-    grids=get_grids_multi_documents(testgrid_path,trees_key_list,args['jobs'])
+    grids=get_grids(trees_key_list)
     feature_vec_list={}
     for grid, trees_and_key  in itertools.izip(grids, trees_key_list):
         if grid and grid.strip()!="":
-            model=new_entity_grid(grid, syntax=True,max_salience=0, history=3)
             key=int(trees_and_key['key'])
-            feature_vec_list[key]=model.get_trans_prob_vctr()
+            feature_vec_list[key]=grid_string_to_trans_prob_vector(grid,history=3,syntax=True)
         else:
             key=int(trees_and_key['key'])
-            feature_vec_list[key]=np.zeros(64)
+            feature_vec_list[key]=np.zeros(ENTITY_FEATURE_DIM)
 
     for key in uniq_list:
         if feature_vec_list.has_key(key):
             pass
         else:
-            feature_vec_list[key]=np.zeros(64)
+            feature_vec_list[key]=np.zeros(ENTITY_FEATURE_DIM)
+    return feature_vec_list
+
+def entity_feature(trees_list,keys=None):
+
+    # input trees_list ["(ROOT (S ..))(ROOT ..)", "2"...] one string per document
+    # keys: optional cache keys, one per document (e.g. tuple of imgids)
+    # output {index: entity transition vector}
+    # only documents missing from entity_feature_cache are sent to TestGrid
+    cache=entity_feature_cache
+    if cache.maxsize<=0 and cache.cache_dir is None:
+        return _entity_feature_grids(trees_list)
+    feature_vec_list={}
+    pending=OrderedDict() #key -> (trees, digest, indices) of documents not cached yet
+    for i,trees in enumerate(trees_list):
+        digest=feature_digest(trees)
+        key=digest if keys is None else (grid_backend,keys[i])
+        if key in pending:
+            pending[key][2].append(i) #same document twice in one call
+            continue
+        vec=cache.get(key,digest)
+        if vec is not None:
+            feature_vec_list[i]=vec
+        else:
+            pending[key]=(trees,digest,[i])
+    if len(pending):
+        miss_vecs=_entity_feature_grids([trees for trees,digest,index in pending.itervalues()])
+        for j,(key,(trees,digest,index)) in enumerate(pending.iteritems()):
+            cache.put(key,miss_vecs[j],digest)
+            for i in index:
+                feature_vec_list[i]=miss_vecs[j]
     return feature_vec_list
 
 
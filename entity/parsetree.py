@@ -9,31 +9,196 @@ import multiprocessing
 import traceback
 import time
 import itertools
+import tempfile
+import shutil
+import atexit
+import select
 from multiprocessing import Pool
 from functools import partial
 
-def make_grid(testgrid_path,trees):
+TESTGRID_BATCH_SIZE=16
+TESTGRID_TIMEOUT=120 #seconds a worker may spend on one batch before it is restarted
+TESTGRID_RETRIES=2
+
+def make_grid(testgrid_path,trees,workdir=None):
+    # trees are written to a private temp file (in workdir when given), so
+    # concurrent jobs never share a file next to the TestGrid binary
     testgrid_base=os.path.dirname(testgrid_path)
-    content_path=os.path.join(testgrid_base,'tmp.txt')
     if type(trees) is dict:
-        content_path=os.path.join(testgrid_base,trees['key'])
         trees=trees['trees']
-    f = open(content_path, 'w')
+    fd,content_path=tempfile.mkstemp(suffix='.txt',dir=workdir)
+    f = os.fdopen(fd, 'w')
     if type(trees)==list:
         f.write('\n'.join(trees))
     else:
         f.write(trees)
     f.close()
-    params = {'TestGrid': './TestGrid','content':content_path}
-    cmd_line = '%(TestGrid)s %(content)s' % (params)
-    cmd_args = shlex.split(cmd_line)
-    proc = subprocess.Popen(cmd_args,cwd=testgrid_base, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-    if os.path.exists(content_path):
-        os.remove(content_path)
+    try:
+        params = {'TestGrid': './TestGrid','content':os.path.abspath(content_path)}
+        cmd_line = '%(TestGrid)s %(content)s' % (params)
+        cmd_args = shlex.split(cmd_line)
+        proc = subprocess.Popen(cmd_args,cwd=testgrid_base, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+    finally:
+        if os.path.exists(content_path):
+            os.remove(content_path)
     # before returning we replace trees of empty segments (marked as so) by empty trees
     return stdout
 
+def _testgrid_worker(testgrid_path,workdir,conn):
+    # long-lived worker: one private temp dir, batches of documents until None
+    # every worker has its own pipe, so a killed worker cannot leave a shared lock held
+    try:
+        while True:
+            task=conn.recv()
+            if task is None:
+                break
+            token,trees_batch=task
+            try:
+                grids=[None if trees is None else make_grid(testgrid_path,trees,workdir) for trees in trees_batch]
+                conn.send((token,grids,None))
+            except:
+                conn.send((token,None,''.join(traceback.format_exception(*sys.exc_info()))))
+    finally:
+        shutil.rmtree(workdir,ignore_errors=True)
+
+class TestGridService(object):
+    """
+    Pool of long-lived TestGrid workers.
+
+    Documents are submitted in batches; every worker owns a private temp dir.
+    A worker that dies or spends more than `timeout` seconds on one batch is
+    restarted and its batch is resubmitted, up to `retries` times, after which
+    the documents of that batch get a None grid.
+
+    Arguments
+    ---------
+    testgrid_path: path to the TestGrid binary
+    jobs: number of workers
+    batch_size: documents per submitted batch
+    """
+    def __init__(self,testgrid_path,jobs=2,batch_size=TESTGRID_BATCH_SIZE,timeout=TESTGRID_TIMEOUT,retries=TESTGRID_RETRIES):
+        self.testgrid_path=testgrid_path
+        self.jobs=jobs
+        self.batch_size=batch_size
+        self.timeout=timeout
+        self.retries=retries
+        self.workers=[]
+        self.restarts=0
+        self.calls=0
+
+    def start(self):
+        if len(self.workers):
+            return self
+        self.workers=[self._spawn() for w in range(self.jobs)]
+        return self
+
+    def _spawn(self):
+        #the dir is owned by the service, so it is removed even if the worker is killed
+        workdir=tempfile.mkdtemp(prefix='testgrid_')
+        conn,child_conn=multiprocessing.Pipe()
+        process=multiprocessing.Process(target=_testgrid_worker,args=(self.testgrid_path,workdir,child_conn))
+        process.daemon=True
+        process.start()
+        child_conn.close()
+        return {'process':process,'conn':conn,'workdir':workdir,'batch':None,'since':None}
+
+    def _restart(self,w):
+        worker=self.workers[w]
+        if worker['process'].is_alive():
+            worker['process'].terminate()
+        worker['process'].join()
+        worker['conn'].close()
+        shutil.rmtree(worker['workdir'],ignore_errors=True)
+        logging.warning('Restarting TestGrid worker %d (exit code %s)', w, worker['process'].exitcode)
+        self.workers[w]=self._spawn()
+        self.restarts+=1
+
+    def healthy(self):
+        return len(self.workers)==self.jobs and all(worker['process'].is_alive() for worker in self.workers)
+
+    def shutdown(self):
+        for worker in self.workers:
+            try:
+                worker['conn'].send(None)
+            except (IOError,OSError):
+                pass #already dead
+        for worker in self.workers:
+            worker['process'].join(5)
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+            worker['conn'].close()
+            shutil.rmtree(worker['workdir'],ignore_errors=True)
+        self.workers=[]
+
+    def get_grids(self,trees_list):
+        # same output as pool.map(wrap_grid, trees_list): one grid string (or None) per document
+        self.start()
+        self.calls+=1
+        call_id=self.calls #results left over from an interrupted call are dropped
+        batches=[trees_list[i:i+self.batch_size] for i in range(0,len(trees_list),self.batch_size)]
+        results=[None]*len(batches)
+        failures=[0]*len(batches)
+        pending=list(range(len(batches)))[::-1]
+        done=0
+        while done<len(batches):
+            for worker in self.workers:
+                if worker['batch'] is None and len(pending) and worker['process'].is_alive():
+                    batch_id=pending.pop()
+                    worker['batch']=(call_id,batch_id)
+                    worker['since']=time.time()
+                    try:
+                        worker['conn'].send(((call_id,batch_id),batches[batch_id]))
+                    except (IOError,OSError):
+                        pass #died meanwhile, handled by the health check
+            busy=[worker for worker in self.workers if worker['batch'] is not None]
+            readable,_,_=select.select([worker['conn'] for worker in busy],[],[],1)
+            for worker in busy:
+                if worker['conn'] not in readable:
+                    continue
+                try:
+                    token,grids,error=worker['conn'].recv()
+                except (EOFError,IOError,OSError):
+                    continue #died, handled by the health check
+                worker['batch']=None
+                if token[0]==call_id and results[token[1]] is None:
+                    if error is not None:
+                        raise Exception(error)
+                    results[token[1]]=grids
+                    done+=1
+            #health check: dead or stuck workers are restarted, their batch is resubmitted
+            for w,worker in enumerate(self.workers):
+                stuck=worker['batch'] is not None and time.time()-worker['since']>self.timeout
+                if worker['process'].is_alive() and not stuck:
+                    continue
+                token=worker['batch']
+                self._restart(w)
+                if token is None or token[0]!=call_id or results[token[1]] is not None:
+                    continue
+                batch_id=token[1]
+                failures[batch_id]+=1
+                if failures[batch_id]>self.retries:
+                    logging.error('TestGrid batch %d failed %d times, skipping it', batch_id, failures[batch_id])
+                    results[batch_id]=[None]*len(batches[batch_id])
+                    done+=1
+                else:
+                    pending.append(batch_id)
+        return [grid for grids in results for grid in grids]
+
+_testgrid_services={}
+
+def get_testgrid_service(testgrid_path,jobs):
+    # one running service per (binary, worker count), shut down at exit
+    key=(os.path.abspath(testgrid_path),jobs)
+    if key not in _testgrid_services:
+        _testgrid_services[key]=TestGridService(testgrid_path,jobs).start()
+    return _testgrid_services[key]
+
+def shutdown_testgrid_services():
+    for service in _testgrid_services.values():
+        service.shutdown()
+    _testgrid_services.clear()
+
 def parse(content, args):
     """
     Parse a number of segments.
@@ -117,20 +282,85 @@ def wrap_grid(trees,testgrid_path):
         return grid
     except:
         raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
+def _call_indexed(task):
+    # runs in a pool worker; errors come back as a formatted traceback
+    func,index,item=task
+    try:
+        return index,func(item),None
+    except:
+        return index,None,''.join(traceback.format_exception(*sys.exc_info()))
+
+class PoolManager(object):
+    """
+    A multiprocessing Pool started once and reused by every call.
+
+    map() streams the tasks with imap_unordered and puts the results back in
+    input order; the first task error is raised in the caller with the worker
+    traceback. The pool is restarted when a different worker count is asked.
+
+    Arguments
+    ---------
+    jobs: number of workers
+    chunksize: tasks sent to a worker at once, None picks len(items)/(4*jobs)
+    """
+    def __init__(self,jobs=2,chunksize=None):
+        self.jobs=jobs
+        self.chunksize=chunksize
+        self.pool=None
+
+    def start(self,jobs=None):
+        if jobs is not None and jobs!=self.jobs:
+            self.shutdown()
+            self.jobs=jobs
+        if self.pool is None:
+            self.pool=Pool(self.jobs)
+        return self
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool=None
+
+    def map(self,func,items,jobs=None,chunksize=None):
+        self.start(jobs)
+        items=list(items)
+        if chunksize is None:
+            chunksize=self.chunksize
+        if chunksize is None:
+            chunksize=max(1,len(items)/(4*self.jobs))
+        results=[None]*len(items)
+        tasks=((func,i,item) for i,item in enumerate(items))
+        for index,result,error in self.pool.imap_unordered(_call_indexed,tasks,chunksize):
+            if error is not None:
+                raise Exception(error)
+            results[index]=result
+        return results
+
+pool_manager=PoolManager()
+
+def start_pools(jobs=2,chunksize=None):
+    # optional: pays the pool startup before the first request
+    pool_manager.chunksize=chunksize
+    pool_manager.start(jobs)
+    return pool_manager
+
+def shutdown_pools():
+    pool_manager.shutdown()
+    shutdown_testgrid_services()
+
+atexit.register(shutdown_pools)
+
 def get_parsed_trees_multi_documents(contents,args):
     # distributes the jobs
-    pool = Pool(args['jobs'])
     logging.info('Distributing %d jobs to %d workers', len(contents), args['jobs'])
-    trees_list = pool.map(partial(wrap_parse, args=args), contents)
-    pool.terminate()
+    trees_list = pool_manager.map(partial(wrap_parse, args=args), contents, args['jobs'])
     return trees_list
 def get_grids_multi_documents(testgrid_path,trees_list,jobs):
-    # distributes the jobs
-    pool = Pool(jobs)
+    # distributes the jobs to the persistent TestGrid workers
+    service = get_testgrid_service(testgrid_path,jobs)
     logging.info('Distributing %d jobs to %d workers', len(trees_list), jobs)
-    gird_list = pool.map(partial(wrap_grid, testgrid_path=testgrid_path), trees_list)
-    pool.close()
-    pool.join()
+    gird_list = service.get_grids(trees_list)
     return gird_list
 def get_grids_a_document(testgrid_path,trees):
     grid = wrap_grid(trees,testgrid_path)
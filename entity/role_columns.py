@@ -0,0 +1,204 @@
+import numpy as np
+
+from tree_grid import *
+from entity_grid import _syntax_role_codes, count_transitions_batch, EntityTransitionState
+
+# An entity grid column belongs to one sentence, so the grid of a candidate
+# document is the columns of its images' sentences in candidate order, joined
+# on entity name. RoleColumnStore computes every corpus sentence column once;
+# transition vectors of many candidate orderings are then counted together on
+# a 3-D role tensor (candidates x entities x sentences), without building tree
+# strings or grids at query time.
+
+ROLE_NB=len(_syntax_role_codes)
+ROLE_NAMES=dict((code,role) for role,code in _syntax_role_codes.items())
+
+class RoleColumnStore(object):
+    """
+    Per sentence entity -> role columns of the corpus, in flat arrays.
+
+    Arguments
+    ---------
+    img_offsets: sentences of image i are img_offsets[i]:img_offsets[i+1]
+    sent_tree: id of the tree string of every sentence (same tree, same id)
+    sent_offsets: columns of sentence j are sent_offsets[j]:sent_offsets[j+1]
+        (one per tree in the tree string, usually one)
+    col_offsets: cells of column k are col_offsets[k]:col_offsets[k+1]
+    cell_entity, cell_role: entity id and role code of every cell
+    entities: entity names by id
+    trees: tree strings by id, for the duplicate rule of make_document_trees
+    """
+    def __init__(self,img_offsets,sent_tree,sent_offsets,col_offsets,cell_entity,cell_role,entities,trees):
+        self.img_offsets=np.asarray(img_offsets,dtype=np.int64)
+        self.sent_tree=np.asarray(sent_tree,dtype=np.int64)
+        self.sent_offsets=np.asarray(sent_offsets,dtype=np.int64)
+        self.col_offsets=np.asarray(col_offsets,dtype=np.int64)
+        self.cell_entity=np.asarray(cell_entity,dtype=np.int64)
+        self.cell_role=np.asarray(cell_role,dtype=np.int8)
+        self.entities=list(entities)
+        self.trees=list(trees)
+
+    @classmethod
+    def from_json_imgs(cls,json_imgs):
+        # json_imgs[imgid]['sentences'][..]['tree'], as make_document_trees reads them
+        tree_ids={}
+        trees=[]
+        entity_ids={}
+        entities=[]
+        img_offsets=[0]
+        sent_tree=[]
+        sent_offsets=[0]
+        col_offsets=[0]
+        cell_entity=[]
+        cell_role=[]
+        for json_img in json_imgs:
+            for sentence in json_img['sentences']:
+                tree=sentence['tree']
+                if tree not in tree_ids:
+                    tree_ids[tree]=len(tree_ids)
+                    trees.append(tree)
+                sent_tree.append(tree_ids[tree])
+                #a tree string may hold several trees, each one is a grid column
+                for column in document_role_columns(tree.encode('ascii','ignore')):
+                    for entity,role in column:
+                        if entity not in entity_ids:
+                            entity_ids[entity]=len(entities)
+                            entities.append(entity)
+                        cell_entity.append(entity_ids[entity])
+                        cell_role.append(_syntax_role_codes[role])
+                    col_offsets.append(len(cell_entity))
+                sent_offsets.append(len(col_offsets)-1)
+            img_offsets.append(len(sent_tree))
+        return cls(img_offsets,sent_tree,sent_offsets,col_offsets,cell_entity,cell_role,entities,trees)
+
+    def save(self,path):
+        np.savez(path,img_offsets=self.img_offsets,sent_tree=self.sent_tree,sent_offsets=self.sent_offsets,
+            col_offsets=self.col_offsets,cell_entity=self.cell_entity,cell_role=self.cell_role,entities=np.array(self.entities,dtype=object),
+            trees=np.array(self.trees,dtype=object))
+
+    @classmethod
+    def load(cls,path):
+        data=np.load(path,allow_pickle=True)
+        if 'trees' not in data.files:
+            raise Exception('%s has no tree strings, delete it to rebuild the role columns.' % path)
+        return cls(data['img_offsets'],data['sent_tree'],data['sent_offsets'],data['col_offsets'],
+            data['cell_entity'],data['cell_role'],data['entities'].tolist(),data['trees'].tolist())
+
+    def sentence_columns(self,j):
+        return range(self.sent_offsets[j],self.sent_offsets[j+1])
+
+    def document_columns(self,imgid_seq):
+        # grid column indices of a candidate document; a tree whose text is
+        # already in the document text is skipped, as make_document_trees does
+        columns=[]
+        document_tree=u""
+        for imgid in imgid_seq:
+            for j in range(self.img_offsets[imgid],self.img_offsets[imgid+1]):
+                tree=self.trees[self.sent_tree[j]]
+                if tree in document_tree:
+                    continue
+                document_tree+=tree
+                columns.extend(self.sentence_columns(j))
+        return columns
+
+    def role_tensor(self,key_seq_list):
+        """
+        3-D role tensor of the candidate documents, (candidates, entities, sentences).
+        Role codes as RoleGrid, '-' where an entity is absent and -1 past the
+        end of a document or for padding entity rows.
+        """
+        if len(key_seq_list)==0:
+            return np.zeros((0,1,1),dtype=np.int8)
+        cand_index=[]
+        cell_index=[]
+        cell_pos=[]
+        nb_sentences=np.zeros(len(key_seq_list),dtype=np.int64)
+        for c,imgid_seq in enumerate(key_seq_list):
+            columns=self.document_columns(imgid_seq)
+            nb_sentences[c]=len(columns)
+            for p,k in enumerate(columns):
+                start,end=self.col_offsets[k],self.col_offsets[k+1]
+                cell_index.append(np.arange(start,end))
+                cell_pos.append(np.repeat(p,end-start))
+                cand_index.append(np.repeat(c,end-start))
+        if len(cell_index):
+            cand_index=np.concatenate(cand_index)
+            cell_index=np.concatenate(cell_index)
+            cell_pos=np.concatenate(cell_pos)
+        else:
+            cand_index=cell_index=cell_pos=np.zeros(0,dtype=np.int64)
+        #local entity row = rank of the entity id among the entities of its candidate
+        nb_vocab=max(len(self.entities),1)
+        keys,local=np.unique(cand_index*nb_vocab+self.cell_entity[cell_index],return_inverse=True)
+        key_cand=keys//nb_vocab
+        first=np.searchsorted(key_cand,np.arange(len(key_seq_list)))
+        local=local-first[cand_index]
+        nb_entities=np.bincount(key_cand,minlength=len(key_seq_list))
+        roles=np.empty((len(key_seq_list),max(nb_entities.max(),1),max(nb_sentences.max(),1)),dtype=np.int8)
+        roles.fill(-1)
+        entity_mask=np.arange(roles.shape[1])[None,:]<nb_entities[:,None]
+        sentence_mask=np.arange(roles.shape[2])[None,:]<nb_sentences[:,None]
+        roles[entity_mask[:,:,None]&sentence_mask[:,None,:]]=0
+        roles[cand_index,local,cell_pos]=self.cell_role[cell_index]
+        return roles
+
+    def trans_prob_vectors(self,key_seq_list,history=3):
+        # (candidates, 4**history) matrix, the same numbers as
+        # grid_string_to_trans_prob_vector(grid of the document, history, syntax=True)
+        return role_tensor_trans_prob_vectors(self.role_tensor(key_seq_list),history)
+
+    def entity_feature(self,key_seq_list,history=3):
+        # drop-in for entity_feature(make_document_trees(key_seq_list,json_imgs))
+        vectors=self.trans_prob_vectors(key_seq_list,history)
+        return dict((i,vectors[i]) for i in range(len(key_seq_list)))
+
+def role_tensor_trans_prob_vectors(roles,history=3):
+    """
+    Transition probability vectors of a batch of grids, (grids, 4**history),
+    for a (grids, entities, sentences) int8 role tensor (-1 = no role),
+    with one salience level as new_entity_grid(.., max_salience=0).
+    """
+    counts=count_transitions_batch(roles,history,ROLE_NB)
+    totals=counts.sum(axis=1)
+    totals[totals==0]=1.
+    return counts/totals[:,None]
+
+class PrefixEntityFeatures(object):
+    """
+    Entity features of candidates that grow one image at a time, as in beam
+    search. The EntityTransitionState of every candidate of the last call is
+    kept, so a candidate of the next call only appends the columns of its
+    last image to the state of its prefix instead of recounting its grid.
+    Gives the same vectors as store.entity_feature(key_seq_list,history).
+    """
+    def __init__(self,store,history=3):
+        self.store=store
+        self.history=history
+        #tuple(imgid_seq) -> (state, document tree text)
+        self.prefixes={}
+
+    def _state(self,key):
+        if key in self.prefixes:
+            return self.prefixes[key]
+        if len(key)==0:
+            return EntityTransitionState(self.history),u""
+        state,document_tree=self._state(key[:-1])
+        state=state.copy()
+        store=self.store
+        for j in range(store.img_offsets[key[-1]],store.img_offsets[key[-1]+1]):
+            tree=store.trees[store.sent_tree[j]]
+            if tree in document_tree:
+                continue
+            document_tree+=tree
+            for k in store.sentence_columns(j):
+                start,end=store.col_offsets[k],store.col_offsets[k+1]
+                state.append([(store.cell_entity[c],ROLE_NAMES[store.cell_role[c]]) for c in range(start,end)])
+        self.prefixes[key]=(state,document_tree)
+        return state,document_tree
+
+    def entity_feature(self,key_seq_list):
+        # drop-in for store.entity_feature(key_seq_list)
+        states=[self._state(tuple(imgid_seq)) for imgid_seq in key_seq_list]
+        #only this call's candidates can be the prefixes of the next one
+        self.prefixes=dict((tuple(imgid_seq),states[i]) for i,imgid_seq in enumerate(key_seq_list))
+        return dict((i,states[i][0].get_trans_prob_vctr()) for i in range(len(key_seq_list)))
@@ -0,0 +1,139 @@
+import numpy as np
+
+from entity_grid import *
+from entity_grid import _syntax_role_codes
+from parsetree import pool_manager
+
+# Pairwise ranking SVM for the entity coherence weights: an original document
+# has to score higher than its sentence permutations, w.(v_orig - v_perm) >= 1.
+# Trained with Pegasos (minibatch SGD on the hinge loss) over the pair
+# difference vectors, which can be streamed from a file on disk.
+
+def permutation_pairs(grid,nb_permutations=20,history=3,syntax=True,seed=1234):
+    """
+    Difference vectors v_orig - v_perm of one document grid (TestGrid string,
+    RoleGrid or EntityGrid) against nb_permutations random sentence orders.
+    Identical orders and pairs that no weight can tell apart are dropped.
+    """
+    if isinstance(grid,EntityGrid):
+        grids=[g for g in grid.grids if len(g)]
+        grid=''.join('%s %s\n' % (entity,' '.join(roles)) for g in grids for entity,roles in g.iterrows())
+    if not isinstance(grid,RoleGrid):
+        grid=RoleGrid.from_string(grid,syntax)
+    nb_sentences=grid.roles.shape[1]
+    dim=len(grid._role_codes())**history
+    if nb_sentences<2 or len(grid.entities)==0:
+        return np.zeros((0,dim),dtype=np.float32)
+    rng=np.random.RandomState(seed)
+    orders=np.array([rng.permutation(nb_sentences) for p in range(nb_permutations)])
+    orders=orders[(orders!=np.arange(nb_sentences)).any(axis=1)]
+    if len(orders)==0:
+        return np.zeros((0,dim),dtype=np.float32)
+    original=grid.get_trans_prob_vctr(history,max_salience=0)
+    permuted=grid.get_permutation_trans_prob_vctrs(orders,history,max_salience=0)
+    pairs=original[None,:]-permuted
+    return pairs[np.abs(pairs).sum(axis=1)>0].astype(np.float32)
+
+def _permutation_pairs_task(task):
+    # pool worker entry, task=(grid, nb_permutations, history, seed)
+    grid,nb_permutations,history,seed=task
+    return permutation_pairs(grid,nb_permutations,history,seed=seed)
+
+class RankSVMTrainer(object):
+    """
+    Arguments
+    ---------
+    nb_permutations: negative (permuted) documents per original
+    history: transition length, 2 gives the 16-d vectors entity_score weighs,
+        3 the 64-d vectors of entity_feature
+    lam: Pegasos regularization
+    nb_epochs: passes over the pairs
+    batch_size: pairs per SGD step
+    pair_path: when given, pairs are appended to this float32 file and read
+        back block by block in train(), so they do not have to fit in memory
+    """
+    def __init__(self,nb_permutations=20,history=3,lam=1e-4,nb_epochs=10,batch_size=256,
+                 pair_path=None,block_rows=1<<16,seed=1234):
+        self.nb_permutations=nb_permutations
+        self.history=history
+        self.lam=lam
+        self.nb_epochs=nb_epochs
+        self.batch_size=batch_size
+        self.pair_path=pair_path
+        self.block_rows=block_rows
+        self.seed=seed
+        self.dim=len(_syntax_role_codes)**history
+        self.nb_pairs=0
+        self.nb_models=0
+        self.pairs=[]
+        self.weights=np.zeros(self.dim)
+        if pair_path is not None:
+            open(pair_path,'wb').close()
+
+    def _add_pairs(self,pairs):
+        if len(pairs)==0:
+            return
+        if self.pair_path is not None:
+            f=open(self.pair_path,'ab')
+            np.asarray(pairs,dtype=np.float32).tofile(f)
+            f.close()
+        else:
+            self.pairs.append(np.asarray(pairs,dtype=np.float32))
+        self.nb_pairs+=len(pairs)
+
+    def add_model(self,model):
+        # model: EntityGrid, RoleGrid or TestGrid string of one original document
+        self._add_pairs(permutation_pairs(model,self.nb_permutations,self.history,seed=self.seed+self.nb_models))
+        self.nb_models+=1
+
+    def add_grids(self,grids,jobs=None):
+        # featurizes many TestGrid strings on the shared process pool
+        tasks=[(grid,self.nb_permutations,self.history,self.seed+self.nb_models+i) for i,grid in enumerate(grids)]
+        self.nb_models+=len(tasks)
+        for pairs in pool_manager.map(_permutation_pairs_task,tasks,jobs):
+            self._add_pairs(pairs)
+
+    def _blocks(self,rng):
+        # pair blocks in random order, rows shuffled inside each block
+        if self.pair_path is not None:
+            data=np.memmap(self.pair_path,dtype=np.float32,mode='r',shape=(self.nb_pairs,self.dim))
+        else:
+            if len(self.pairs)>1:
+                self.pairs=[np.concatenate(self.pairs)]
+            data=self.pairs[0]
+        starts=np.arange(0,self.nb_pairs,self.block_rows)
+        rng.shuffle(starts)
+        for start in starts:
+            block=np.array(data[start:start+self.block_rows])
+            rng.shuffle(block)
+            yield block
+
+    def train(self):
+        if self.nb_pairs==0:
+            raise Exception('RankSVMTrainer has no training pairs.')
+        rng=np.random.RandomState(self.seed)
+        w=np.zeros(self.dim)
+        radius=1./np.sqrt(self.lam)
+        t=0
+        for epoch in range(self.nb_epochs):
+            for block in self._blocks(rng):
+                for start in range(0,len(block),self.batch_size):
+                    batch=block[start:start+self.batch_size]
+                    t+=1
+                    eta=1./(self.lam*t)
+                    violated=batch[np.dot(batch,w)<1.]
+                    w*=1.-eta*self.lam
+                    if len(violated):
+                        w+=eta/len(batch)*violated.sum(axis=0)
+                    norm=np.sqrt(np.dot(w,w))
+                    if norm>radius:
+                        w*=radius/norm
+        self.weights=w
+        return w
+
+    def accuracy(self):
+        # fraction of training pairs ranked correctly, w.(v_orig - v_perm) > 0
+        correct=0
+        for block in self._blocks(np.random.RandomState(self.seed)):
+            correct+=(np.dot(block,self.weights)>0).sum()
+        return correct/float(max(self.nb_pairs,1))
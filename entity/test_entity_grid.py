@@ -0,0 +1,57 @@
+#checks the numpy RoleGrid against the pandas EntityGrid it replaces
+#python test_entity_grid.py
+import json
+import os
+import unittest
+
+import numpy as np
+
+from entity_grid import *
+
+fixture_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)),'fixtures')
+
+def random_grid(rng,nb_entities,nb_sentences):
+    # TestGrid format, roles drawn with '-' the most frequent as in real grids
+    rows=rng.choice(list('-OSX'),size=(nb_entities,nb_sentences),p=[0.55,0.15,0.15,0.15])
+    return ''.join('e%d %s\n' % (e,' '.join(row)) for e,row in enumerate(rows))
+
+class TestRoleGrid(unittest.TestCase):
+    def setUp(self):
+        rng=np.random.RandomState(1337)
+        self.grids=[random_grid(rng,rng.randint(1,12),rng.randint(1,9)) for i in range(30)]
+        fixtures=json.load(open(os.path.join(fixture_dir,'grid_trees.json'),'r'))
+        self.grids+=[str(fixture['grid']) for fixture in fixtures]
+
+    def test_matches_entity_grid(self):
+        for grid in self.grids:
+            for history in [2,3]:
+                for max_salience in [0,1,2]:
+                    model=new_entity_grid(grid,syntax=True,max_salience=max_salience,history=history)
+                    role_grid=RoleGrid.from_string(grid)
+                    np.testing.assert_array_equal(role_grid.get_trans_cnt_vctr(history,max_salience),model.get_trans_cnt_vctr(),grid)
+                    np.testing.assert_allclose(role_grid.get_trans_prob_vctr(history,max_salience),model.get_trans_prob_vctr(),err_msg=grid)
+                    np.testing.assert_allclose(grid_string_to_trans_prob_vector(grid,history,True,max_salience),model.get_trans_prob_vctr(),err_msg=grid)
+
+    def test_permutations_match_partial_grids(self):
+        rng=np.random.RandomState(1234)
+        checked=0
+        for grid in self.grids:
+            role_grid=RoleGrid.from_string(grid)
+            nb_sentences=role_grid.roles.shape[1]
+            for history in [2,3]:
+                for max_salience in [0,2]:
+                    model=new_entity_grid(grid,syntax=True,max_salience=max_salience,history=history)
+                    if any(len(level)==0 for level in model.grids):
+                        continue #get_partial_grid cannot index the columns of an empty salience level
+                    checked+=1
+                    #whole orderings and orderings of fewer sentences than the document
+                    for length in set([nb_sentences,max(1,nb_sentences-2)]):
+                        indices=np.array([rng.permutation(nb_sentences)[:length] for i in range(5)])
+                        vectors=role_grid.get_permutation_trans_prob_vctrs(indices,history,max_salience)
+                        for i in range(len(indices)):
+                            partial=model.get_partial_grid(list(indices[i]))
+                            np.testing.assert_allclose(vectors[i],partial.get_trans_prob_vctr(),err_msg='%s %s' % (grid,indices[i]))
+        self.assertTrue(checked>=len(self.grids))
+
+if __name__ == '__main__':
+    unittest.main()
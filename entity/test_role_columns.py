@@ -0,0 +1,73 @@
+#checks the incremental entity features of beam search against full recounts,
+#and against the pandas EntityGrid of every prefix
+#python test_role_columns.py
+import json
+import os
+import unittest
+
+import numpy as np
+
+from role_columns import *
+from entity_grid import RoleGrid, new_entity_grid
+
+def entity_grid_vector(grid,history=3):
+    # reference vector of a grid string, zeros for a document without entities
+    if grid.strip()=="":
+        return np.zeros(ROLE_NB**history)
+    return new_entity_grid(grid,syntax=True,max_salience=0,history=history).get_trans_prob_vctr()
+
+fixture_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)),'fixtures')
+
+def document_trees(json_imgs,imgid_seq):
+    # tree text of a candidate, as make_document_trees joins it
+    document_tree=u""
+    for imgid in imgid_seq:
+        for sentence in json_imgs[imgid]['sentences']:
+            if sentence['tree'] not in document_tree:
+                document_tree+=sentence['tree']
+    return document_tree
+
+class TestRoleColumns(unittest.TestCase):
+    def setUp(self):
+        fixtures=json.load(open(os.path.join(fixture_dir,'grid_trees.json'),'r'))
+        #one image per fixture, one sentence per tree; the last image repeats
+        #a sentence of the first one, which make_document_trees drops
+        json_imgs=[{'sentences':[{'tree':tree} for tree in fixture['trees'].strip().split('\n')]} for fixture in fixtures]
+        json_imgs.append({'sentences':[json_imgs[0]['sentences'][0],json_imgs[1]['sentences'][0]]})
+        self.json_imgs=json_imgs
+        self.store=RoleColumnStore.from_json_imgs(json_imgs)
+        self.nb_imgs=len(json_imgs)
+
+    def test_transition_state_matches_role_grid(self):
+        rng=np.random.RandomState(1337)
+        for history in [2,3]:
+            roles=rng.randint(0,ROLE_NB,size=(6,9)).astype(np.int8)
+            roles[rng.rand(*roles.shape)<0.4]=0
+            state=EntityTransitionState(history)
+            for s in range(roles.shape[1]):
+                state.append([(e,ROLE_NAMES[roles[e,s]]) for e in range(roles.shape[0]) if roles[e,s]!=0])
+                #the grid of the prefix has the entities seen so far
+                prefix=roles[(roles[:,:s+1]!=0).any(axis=1),:s+1]
+                grid=RoleGrid(range(len(prefix)),prefix,(prefix!=0).sum(axis=1))
+                np.testing.assert_array_equal(state.get_trans_cnt_vctr(),grid.get_trans_cnt_vctr(history,0))
+                np.testing.assert_allclose(state.get_trans_prob_vctr(),grid.get_trans_prob_vctr(history,0))
+                grid_str=''.join('e%d %s\n' % (e,' '.join(ROLE_NAMES[r] for r in row)) for e,row in enumerate(prefix))
+                np.testing.assert_allclose(state.get_trans_prob_vctr(),entity_grid_vector(grid_str,history))
+
+    def test_prefix_features_match_store(self):
+        prefix_features=PrefixEntityFeatures(self.store)
+        beam_list=[[]]
+        for position in range(4):
+            #every image at every position, with repeats, as the topk lists of a stream may have
+            key_seq_list=[beam+[imgid] for beam in beam_list for imgid in range(self.nb_imgs)]
+            incremental=prefix_features.entity_feature(key_seq_list)
+            recounted=self.store.entity_feature(key_seq_list)
+            for i in range(len(key_seq_list)):
+                np.testing.assert_allclose(incremental[i],recounted[i],err_msg=str(key_seq_list[i]))
+                document_tree=document_trees(self.json_imgs,key_seq_list[i])
+                reference=entity_grid_vector(make_grid_python(document_tree.encode('ascii','ignore')))
+                np.testing.assert_allclose(incremental[i],reference,err_msg=str(key_seq_list[i]))
+            beam_list=key_seq_list[position::7][:3]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+#checks the in-process grids of tree_grid.py against the hand-checked grids of the fixture trees,
+#and against TestGrid grids recorded on them when present (python verify_tree_grid.py --record)
+#python test_tree_grid.py
+import json
+import os
+import unittest
+
+from tree_grid import *
+
+fixture_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)),'fixtures')
+
+class TestTreeGrid(unittest.TestCase):
+    def setUp(self):
+        self.fixtures=json.load(open(os.path.join(fixture_dir,'grid_trees.json'),'r'))
+
+    def test_fixture_trees_parse(self):
+        for fixture in self.fixtures:
+            self.assertEqual(len(parse_trees(fixture['trees'])),len(fixture['trees'].strip().split('\n')))
+
+    def test_matches_expected_grids(self):
+        for fixture in self.fixtures:
+            self.assertEqual(grid_rows(make_grid_python(fixture['trees'])),grid_rows(fixture['grid']),fixture['key'])
+
+    def test_possessor_and_conjuncts(self):
+        fixtures=dict((fixture['key'],fixture['trees'].split('\n')) for fixture in self.fixtures)
+        self.assertEqual(sentence_roles(parse_trees(fixtures['possessive'][0])[0]),[('dog','S'),('girl','X'),('ball','O')])
+        self.assertEqual(dict(sentence_roles(parse_trees(fixtures['prepositional_and_coordination'][0])[0]))['park'],'O')
+
+    def test_matches_testgrid(self):
+        recorded_path=os.path.join(fixture_dir,'testgrid_grids.json')
+        if not os.path.exists(recorded_path):
+            self.skipTest('no recorded TestGrid grids, run verify_tree_grid.py --record next to a TestGrid build')
+        recorded=json.load(open(recorded_path,'r'))
+        for fixture in self.fixtures:
+            self.assertEqual(grid_rows(make_grid_python(fixture['trees'])),grid_rows(recorded[fixture['key']]),fixture['key'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 #import entity_grid
 from entity_grid import *
 from parsetree import *
+from tree_grid import *
 import svm as disvm
 import json
 import pickle
@@ -20,7 +21,9 @@ args['grammar']="/data/cspark/stanford-parser-full-2014-10-31/englishPCFG.casele
 args['threads']=2
 args['max_length']=1000
 testgrid_path="/data/cspark/browncoherence/bin64/TestGrid"
-trainer = disvm.RankSVMTrainer(20)
+grid_backend='testgrid' # same grids as entity_score; 'python' builds them in-process (tree_grid.py)
+# entity_score dots the weights with history=2 vectors, so train on the same 16-d transitions
+trainer = disvm.RankSVMTrainer(20,history=2,pair_path='./data/example_rank_pairs.bin')
 
 jsonfile = open('./data/example_tree.json', 'r')
 
@@ -36,7 +39,7 @@ for json_img in json_imgs:
 	if contents.has_key(pageurl):
 		concattree=contents[pageurl]
 	for sentence in json_img['sentences']:
-		encode_tree=sentence['raw'].encode('ascii','ignore')
+		encode_tree=sentence['tree'].encode('ascii','ignore')
 		if encode_tree in concattree:
 			pass
 		else:
@@ -54,10 +57,13 @@ for k,content in contents.iteritems():
 
 
 trees_key_list=[]
-for trees, key in itertools.izip(trees_list, uniq_list):
+for trees, key in itertools.izip(tree_list, key_list):
     if len(trees.strip())!=0:
-        trees_key_list.append({'trees':trees.encode('ascii','ignore'),'key':str(key)})
-grids=get_grids_multi_documents(testgrid_path,trees_key_list,args['jobs'])
+        trees_key_list.append({'trees':trees,'key':str(key)})
+if grid_backend=='python':
+    grids=pool_manager.map(make_grid_python,trees_key_list,args['jobs'])
+else:
+    grids=get_grids_multi_documents(testgrid_path,trees_key_list,args['jobs'])
 
 
 # trees_key_list=[]
@@ -70,13 +76,10 @@ grids=get_grids_multi_documents(testgrid_path,trees_key_list,args['jobs'])
 # print "disney grid dump"
 # pickle.dump( grids, open( "./data/disney_grid_list.p", "wb" ) )
 #data_entities=[]
-for grid, trees_and_key  in itertools.izip(grids, trees_key_list):
-	if grid and grid.strip()!="":
-
-		model=new_entity_grid(grid, syntax=True,max_salience=0, history=3)
-		trainer.add_model(model)
-print "training start"
+trainer.add_grids([grid for grid in grids if grid and grid.strip()!=""],args['jobs'])
+print "training start", trainer.nb_pairs, "pairs"
 trainer.train()
 ntsb_weights = trainer.weights
 print ntsb_weights
+print "pairwise accuracy", trainer.accuracy()
 pickle.dump( ntsb_weights, open( "./data/example_weights.p", "wb" ) )
@@ -0,0 +1,178 @@
+import re
+
+# In-process candidate for browncoherence TestGrid: builds the entity grid
+# string read by parse_grid_string straight from Penn Treebank trees.
+# Checked on hand-made grids of fixture trees, not yet shown to match TestGrid,
+# see test_tree_grid.py.
+# Entities are head nouns (lowercased), one column per tree, roles are
+# S (NP under a clause), O (NP under a VP), X (any other NP), - (absent);
+# the conjuncts of a coordinated NP take its role, a possessor is an X.
+
+_token_re=re.compile(r'\(|\)|[^\s()]+')
+
+_noun_tags=set(['NN','NNS','NNP','NNPS'])
+_clause_labels=set(['S','SINV','SQ','SBARQ'])
+
+# When the same entity occurs more than once in a sentence,
+# take the role with the highest precedence.
+_role_precedence={'S':3,'O':2,'X':1,'-':0}
+
+# Collins head rules for NP, applied in order: (direction, labels)
+_np_head_rules=[
+    ('right',set(['NN','NNP','NNPS','NNS','NX','POS','JJR'])),
+    ('left',set(['NP'])),
+    ('right',set(['$','ADJP','PRN'])),
+    ('right',set(['CD'])),
+    ('right',set(['JJ','JJS','RB','QP'])),
+]
+
+def _base_label(label):
+    # NP-SBJ-1 -> NP, NP=2 -> NP; -NONE-, -LRB- are kept
+    if label.startswith('-'):
+        return label
+    return re.split('[-=]',label)[0]
+
+def parse_trees(trees):
+    """
+    Parse one or more bracketed trees, '(ROOT ..)(ROOT ..)' or one per line.
+
+    Returns
+    -------
+    list of trees, a tree is (label, children) and a leaf is a word string
+    """
+    if type(trees)==list:
+        trees='\n'.join(trees)
+    stack=[]
+    parsed=[]
+    tokens=_token_re.findall(trees)
+    i=0
+    while i<len(tokens):
+        token=tokens[i]
+        if token=='(':
+            label=''
+            if i+1<len(tokens) and tokens[i+1] not in ('(',')'):
+                label=tokens[i+1]
+                i+=1
+            stack.append((label,[]))
+        elif token==')':
+            if len(stack)==0:
+                raise Exception('Unbalanced tree: '+trees[:100])
+            node=stack.pop()
+            if len(stack):
+                stack[-1][1].append(node)
+            else:
+                parsed.append(node)
+        else:
+            if len(stack)==0:
+                raise Exception('Word outside a tree: '+token)
+            stack[-1][1].append(token)
+        i+=1
+    if len(stack):
+        raise Exception('Unbalanced tree: '+trees[:100])
+    return parsed
+
+def _is_preterminal(node):
+    return len(node[1])==1 and not isinstance(node[1][0],tuple)
+
+def _np_head_child(node):
+    children=[child for child in node[1] if isinstance(child,tuple) and _base_label(child[0])!='-NONE-']
+    if len(children)==0:
+        return None
+    if _base_label(children[-1][0])=='POS' and len(children)>1:
+        #possessive NP (the girl 's): the possessor is the entity, not the clitic
+        children=children[:-1]
+    for direction,labels in _np_head_rules:
+        ordered=children if direction=='left' else children[::-1]
+        for child in ordered:
+            if _base_label(child[0]) in labels:
+                return child
+    return children[-1]
+
+def _head_word(node):
+    # follows the NP head child down to a preterminal, (tag, word)
+    while node is not None and not _is_preterminal(node):
+        node=_np_head_child(node)
+    if node is None:
+        return None
+    return _base_label(node[0]),node[1][0]
+
+def _np_role(parent_label):
+    if parent_label in _clause_labels:
+        return 'S'
+    if parent_label=='VP':
+        return 'O'
+    return 'X'
+
+def _is_coordinated_np(node):
+    # (NP (NP ..) (CC and) (NP ..)): every conjunct fills the role of the whole NP
+    labels=[_base_label(child[0]) for child in node[1] if isinstance(child,tuple)]
+    return ('CC' in labels or 'CONJP' in labels) and labels.count('NP')>1
+
+def sentence_roles(tree):
+    """
+    Entity -> role of one sentence tree, in order of first mention.
+    """
+    roles={}
+    order=[]
+    #(node, role the node has if it is an NP)
+    stack=[(tree,'X')]
+    while len(stack):
+        node,role=stack.pop()
+        label=_base_label(node[0])
+        if label=='NP':
+            head=_head_word(node)
+            if head is not None and head[0] in _noun_tags:
+                entity=head[1].lower()
+                if entity not in roles:
+                    roles[entity]='-'
+                    order.append(entity)
+                if _role_precedence[role]>_role_precedence[roles[entity]]:
+                    roles[entity]=role
+        conjunct_role=role if label=='NP' and _is_coordinated_np(node) else None
+        #children pushed in reverse so they are visited left to right
+        for child in reversed(node[1]):
+            if isinstance(child,tuple):
+                if conjunct_role is not None and _base_label(child[0])=='NP':
+                    stack.append((child,conjunct_role))
+                else:
+                    stack.append((child,_np_role(label)))
+    return [(entity,roles[entity]) for entity in order]
+
+def document_role_columns(trees):
+    # one [(entity, role), ..] column per sentence tree of the document
+    return [sentence_roles(tree) for tree in parse_trees(trees)]
+
+def grid_from_role_columns(columns):
+    """
+    Entity grid string in the TestGrid format, one line per entity:
+    'entity r1 r2 .. rn' with one role per sentence.
+    """
+    grid={}
+    order=[]
+    for s,column in enumerate(columns):
+        for entity,role in column:
+            if entity not in grid:
+                grid[entity]=['-']*len(columns)
+                order.append(entity)
+            grid[entity][s]=role
+    return ''.join('%s %s\n' % (entity,' '.join(grid[entity])) for entity in order)
+
+def make_grid_python(trees):
+    """
+    Same contract as parsetree.make_grid without the TestGrid subprocess:
+    trees is a tree string, a list of tree strings or {'trees':..,'key':..}.
+    """
+    if trees is None:
+        return None
+    if type(trees) is dict:
+        trees=trees['trees']
+    return grid_from_role_columns(document_role_columns(trees))
+
+def get_grids_python(trees_list):
+    return [make_grid_python(trees) for trees in trees_list]
+
+def grid_rows(grid):
+    # entity grid as a sorted list of (entity, roles..) rows, to compare grids
+    if not grid or grid.strip()=="":
+        return []
+    return sorted(tuple(line.strip().lower().split(" ")) for line in grid.strip().split("\n") if line.strip()!="")
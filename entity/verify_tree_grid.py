@@ -0,0 +1,78 @@
+#compares the in-process entity grids (tree_grid.py) with TestGrid on the trees of example_tree.json
+#run next to a browncoherence build: python verify_tree_grid.py [nb_documents] [-v]
+#python verify_tree_grid.py --record writes the TestGrid grids of fixtures/grid_trees.json
+#to fixtures/testgrid_grids.json, which test_tree_grid.py diffs make_grid_python against
+from entity_grid import *
+from parsetree import *
+from tree_grid import *
+import json
+import os
+import sys
+import time
+
+entity_dir=os.path.dirname(os.path.abspath(__file__))
+testgrid_path=os.path.join(entity_dir,"..","browncoherence","bin64","TestGrid")
+verbose='-v' in sys.argv
+numbers=[arg for arg in sys.argv[1:] if arg.isdigit()]
+nb_documents=200
+if len(numbers):
+    nb_documents=int(numbers[0])
+
+if '--record' in sys.argv:
+    fixtures=json.load(open(os.path.join(entity_dir,'fixtures','grid_trees.json'),'r'))
+    recorded={}
+    for fixture in fixtures:
+        recorded[fixture['key']]=get_grids_a_document(testgrid_path,fixture['trees'].encode('ascii','ignore'))
+    fname=open(os.path.join(entity_dir,'fixtures','testgrid_grids.json'),'w')
+    json.dump(recorded,fname,indent=1,sort_keys=True)
+    fname.close()
+    print 'recorded', len(recorded), 'TestGrid grids'
+    sys.exit(0)
+
+jsonfile = open(os.path.join(entity_dir,'..','data','example_tree.json'), 'r')
+json_data=jsonfile.read()
+jsondata=json.loads(json_data)
+jsonfile.close()
+json_imgs=jsondata['images']
+
+#fixtures: documents of 1 to 5 consecutive images, like the candidates of topk_utils
+trees_key_list=[]
+for i in range(0,len(json_imgs),5):
+    document_tree=""
+    for json_img in json_imgs[i:i+1+(i/5)%5]:
+        for sentence in json_img['sentences']:
+            if sentence['tree'] not in document_tree:
+                document_tree+=sentence['tree']
+    if len(document_tree.strip())!=0:
+        trees_key_list.append({'trees':document_tree.encode('ascii','ignore'),'key':'verify_%d' % i})
+    if len(trees_key_list)==nb_documents:
+        break
+
+start=time.time()
+testgrid_grids=[get_grids_a_document(testgrid_path,trees) for trees in trees_key_list]
+testgrid_time=time.time()-start
+start=time.time()
+python_grids=get_grids_python(trees_key_list)
+python_time=time.time()-start
+
+def grid_vector(grid):
+    if not grid or grid.strip()=="":
+        return np.zeros(64)
+    return new_entity_grid(grid,syntax=True,max_salience=0,history=3).get_trans_prob_vctr()
+
+grid_match=0
+vector_match=0
+for testgrid_grid,python_grid,trees in itertools.izip(testgrid_grids,python_grids,trees_key_list):
+    if grid_rows(testgrid_grid)==grid_rows(python_grid):
+        grid_match+=1
+    if np.allclose(grid_vector(testgrid_grid),grid_vector(python_grid)):
+        vector_match+=1
+    elif verbose:
+        print trees['key']
+        print testgrid_grid
+        print python_grid
+
+print 'documents', len(trees_key_list)
+print 'identical grids', grid_match
+print 'identical 64-d vectors', vector_match
+print 'TestGrid %.4fs per document, tree_grid %.4fs per document' % (testgrid_time/max(len(trees_key_list),1),python_time/max(len(trees_key_list),1))
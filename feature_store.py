@@ -0,0 +1,60 @@
+import os
+import sys
+import numpy as np
+import scipy.io
+
+def feature_store_path(mat_path):
+    # the converted store lives next to the .mat file
+    return os.path.splitext(mat_path)[0]+'.npy'
+
+def convert_mat_features(mat_path,store_path=None,dtype=np.float32):
+    """
+    Write the 'feats' matrix of a .mat file once as a row-major .npy file
+    (image count, feature dim), so it can be memory-mapped by load_features.
+    """
+    if store_path is None:
+        store_path=feature_store_path(mat_path)
+    feats=scipy.io.loadmat(mat_path)['feats'] # feature dim * image count
+    #write then rename, an interrupted conversion never leaves a newer partial store
+    tmp_path='%s.%d.tmp' % (store_path,os.getpid())
+    store=np.lib.format.open_memmap(tmp_path,mode='w+',dtype=dtype,shape=(feats.shape[1],feats.shape[0]))
+    block_size=4096
+    for start in range(0,feats.shape[1],block_size):
+        end=min(feats.shape[1],start+block_size)
+        store[start:end]=feats[:,start:end].T
+    store.flush()
+    del store
+    os.rename(tmp_path,store_path)
+    return store_path
+
+def load_features(features_path):
+    """
+    Load corpus features as an (image count, feature dim) array.
+    A .mat file is read and transposed as before; a .npy store is memory-mapped
+    read only, so startup does not read the matrix and the page cache is shared
+    between processes.
+    """
+    if features_path.endswith('.mat'):
+        return scipy.io.loadmat(features_path)['feats'].transpose()
+    return np.load(features_path,mmap_mode='r')
+
+def is_stale(path,*source_paths):
+    # a derived file is stale when missing or older than one of its existing sources
+    if not os.path.exists(path):
+        return True
+    mtime=os.path.getmtime(path)
+    return any(os.path.exists(source) and mtime<os.path.getmtime(source) for source in source_paths)
+
+def resolve_features_path(mat_path):
+    # prefer the converted store when it exists and is not older than the .mat
+    store_path=feature_store_path(mat_path)
+    if not os.path.exists(store_path):
+        return mat_path
+    if is_stale(store_path,mat_path):
+        print "feature store", store_path, "is older than", mat_path, "- reading the .mat, reconvert with python feature_store.py", mat_path
+        return mat_path
+    return store_path
+
+if __name__=='__main__':
+    for mat_path in sys.argv[1:]:
+        print "converted", mat_path, "to", convert_mat_features(mat_path)
@@ -4,23 +4,40 @@ sys.path.append('./keras')
 sys.path.append("./entity")
 import json
 import scipy.io
+from feature_store import *
 
 from gensim import models
 from load_models import *
 from topk_utils import *
+from ann_index import IVFPQIndex
 
-jsonfile = open('./data/example_tree.json', 'r')
+TREE_JSON_PATH='./data/example_tree.json'
+jsonfile = open(TREE_JSON_PATH, 'r')
 json_data=jsonfile.read()
 jsondata=json.loads(json_data)
 jsonfile.close()
 json_imgs=jsondata['images']
 
 
-features_path = os.path.join('./data/', 'example.mat')
-features_struct = scipy.io.loadmat(features_path)['feats'].transpose() # this features array length have to be same with images length
+features_path = resolve_features_path(os.path.join('./data/', 'example.mat'))
+features_struct = load_features(features_path) # this features array length have to be same with images length
 
 DOC2VEC_MODEL_PATH='./model/example.doc2vec'
 
+ANN_INDEX_PATH='./model/example.ivfpq.npz' # built by ann_index_training.py, exact search is used when missing
+ANN_NPROBE=16
+
+SEARCH_STRATEGY='cartesian' # 'beam' scales linearly with the stream length
+SCORE_MODE='full' # 'lowrank' folds the linear output head into a per-query projection,
+                  # 'precomputed' projects the corpus doc2vec vectors through the BLSTM gates once
+
+ENTITY_CACHE_DIR='./model/entity_cache' # entity grid vectors by tree text digest, reused across runs; None keeps them in memory only
+entity_cache=set_entity_feature_cache(cache_dir=ENTITY_CACHE_DIR)
+
+ann_index=None
+if os.path.exists(ANN_INDEX_PATH):
+    ann_index=IVFPQIndex.load(ANN_INDEX_PATH,features_struct)
+
 
 jsonfile = open('./data/example_test.json', 'r')
 json_data=jsonfile.read()
@@ -29,8 +46,8 @@ jsonfile.close()
 json_imgs_test=jsondata['images']
 
 
-features_path = os.path.join('./data/', 'example_test.mat')
-features_struct_test = scipy.io.loadmat(features_path)['feats'].transpose() # this features array length have to be same with images length
+features_path = resolve_features_path(os.path.join('./data/', 'example_test.mat'))
+features_struct_test = load_features(features_path) # this features array length have to be same with images length
 
 RCN_MODEL_PATH='./model/rcn_5.hdf5'
 CRCN_MODEL_PATH='./model/crcn_5.hdf5'
@@ -63,15 +80,56 @@ count=0
 
 model_loaded_entity = create_crcn_blstm()
 model_loaded_entity.load_weights(CRCN_MODEL_PATH)
-model_loaded_entity.compile(loss='crcn_score_func',optimizer='rmsprop')
+model_loaded_entity.compile(loss='crcn_score_func',optimizer='rmsprop',score='crcn_score_vec_func')
+if SCORE_MODE=='lowrank':
+    model_loaded_entity=LowRankScorer(model_loaded_entity)
+elif SCORE_MODE=='precomputed':
+    model_loaded_entity=PrecomputedGateScorer(model_loaded_entity)
+warmup_model(model_loaded_entity,SPLIT_VAL,is_entity=True)
 
 
 model_loaded = create_rcn_blstm()
 model_loaded.load_weights(RCN_MODEL_PATH)
-model_loaded.compile(loss='rcn_score_func',optimizer='rmsprop')
-
-
-doc2vecmodel = models.Doc2Vec.load(DOC2VEC_MODEL_PATH)
+model_loaded.compile(loss='rcn_score_func',optimizer='rmsprop',score='rcn_score_vec_func')
+if SCORE_MODE=='lowrank':
+    model_loaded=LowRankScorer(model_loaded)
+elif SCORE_MODE=='precomputed':
+    model_loaded=PrecomputedGateScorer(model_loaded)
+warmup_model(model_loaded,SPLIT_VAL)
+
+
+DOCVEC_MATRIX_PATH='./model/example.docvecs.npz' # dense export of the doc2vec vectors, rewritten when older than the model or the corpus
+
+docvecs=None
+if not is_stale(DOCVEC_MATRIX_PATH,DOC2VEC_MODEL_PATH,TREE_JSON_PATH):
+    docvecs=DocVecMatrix.load(DOCVEC_MATRIX_PATH)
+    if not docvecs.matches([json_img['imgid'] for json_img in json_imgs]):
+        docvecs=None
+if docvecs is None:
+    doc2vecmodel = models.Doc2Vec.load(DOC2VEC_MODEL_PATH)
+    docvecs=DocVecMatrix.from_doc2vec(doc2vecmodel,[json_img['imgid'] for json_img in json_imgs])
+    docvecs.save(DOCVEC_MATRIX_PATH)
+
+USE_ROLE_COLUMNS=False # True counts CRCN entity features from stored per sentence roles (in-process grids,
+                       # needs entity_score.grid_backend='python'); False runs entity_feature on the grid_backend
+ROLE_COLUMNS_PATH='./model/example.rolecolumns.npz' # per sentence entity roles of the corpus trees, rewritten when older than
+                                                     # the corpus or the role builder
+
+role_columns=None
+if USE_ROLE_COLUMNS:
+    if not is_stale(ROLE_COLUMNS_PATH,TREE_JSON_PATH,'./entity/tree_grid.py'):
+        role_columns=RoleColumnStore.load(ROLE_COLUMNS_PATH)
+        if len(role_columns.img_offsets)!=len(json_imgs)+1 or role_columns.img_offsets[-1]!=sum(len(json_img['sentences']) for json_img in json_imgs):
+            role_columns=None
+    if role_columns is None:
+        role_columns=RoleColumnStore.from_json_imgs(json_imgs)
+        role_columns.save(ROLE_COLUMNS_PATH)
+
+sentvecs_entity=docvecs
+sentvecs=docvecs
+if SCORE_MODE=='precomputed':
+    sentvecs_entity=docvecs.project(model_loaded_entity.layer.project_inputs)
+    sentvecs=docvecs.project(model_loaded.layer.project_inputs)
 
 
 crcn_output_list=[]
@@ -82,13 +140,15 @@ rcn_output_list=[]
 for i,tests in enumerate(testset):
 
     count+=1
-    crcn_output=output_list_topk_crcn(tests[1],json_imgs,features_struct,doc2vecmodel,model_loaded_entity)
+    crcn_output=output_list_topk_crcn(tests[1],json_imgs,features_struct,sentvecs_entity,model_loaded_entity,ann_index=ann_index,nprobe=ANN_NPROBE,search=SEARCH_STRATEGY,role_columns=role_columns)
     crcn_output_list.append(crcn_output)
 
-    rcn_output=output_list_topk_rcn(tests[1],json_imgs,features_struct,doc2vecmodel,model_loaded)
+    rcn_output=output_list_topk_rcn(tests[1],json_imgs,features_struct,sentvecs,model_loaded,ann_index=ann_index,nprobe=ANN_NPROBE,search=SEARCH_STRATEGY)
     rcn_output_list.append(rcn_output)
     print i
 
+entity_cache.flush()
+print 'entity feature cache',entity_cache.stats()
 pickle.dump(crcn_output_list,open('./output_crcn.p','w'))
 pickle.dump(rcn_output_list,open('./output_rcn.p','w'))
 
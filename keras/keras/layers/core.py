@@ -212,14 +212,11 @@ class TimeDistributedDense(Layer):
 
     def output(self, train):
         X = self.get_input(train)
-
-        def act_func(X):
-            return self.activation(T.dot(X, self.W) + self.b)
-
-        output, _ = theano.scan(fn = act_func,
-                                sequences = X.dimshuffle(1,0,2),
-                                outputs_info=None)
-        return output.dimshuffle(1,0,2)
+        # all timesteps of all samples as the rows of one matrix, so the
+        # activation still sees (rows, output_dim) as in a Dense layer
+        Xr = X.reshape((X.shape[0] * X.shape[1], self.input_dim))
+        output = self.activation(T.dot(Xr, self.W) + self.b)
+        return output.reshape((X.shape[0], X.shape[1], self.output_dim))
 
     def get_config(self):
         return {"name":self.__class__.__name__,
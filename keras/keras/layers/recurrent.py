@@ -5,25 +5,108 @@ import theano.tensor as T
 import numpy as np
 
 from .. import activations, initializations
-from ..utils.theano_utils import shared_zeros, alloc_zeros_matrix
+from ..utils.theano_utils import shared_zeros, sharedX, alloc_zeros_matrix
 from ..layers.core import Layer
 from .. import regularizers
+from theano.tensor.opt import Assert
 
 from six.moves import range
 
+# Masking: with mask_zero=True, timesteps whose input vector is all zeros are
+# padding. Sequences are padded at the end, so a forward scan is exact on
+# the valid steps; what depends on the padding is the time reversal, which
+# is then done per sample within its own length.
+def _zero_mask(X):
+    # X: (time, nb_samples, dim) -> (time, nb_samples), 0 on padding
+    return T.cast(T.neq(T.sum(T.abs_(X), axis=2), 0), theano.config.floatX)
+
+def _gather_steps(X, steps):
+    # X[steps[t, i], i] for a (time, nb_samples) integer matrix of steps
+    nb_samples = X.shape[1]
+    rows = (steps * nb_samples + T.arange(nb_samples).dimshuffle('x', 0)).flatten()
+    return X.reshape((X.shape[0] * nb_samples, X.shape[2]))[rows].reshape((steps.shape[0], nb_samples, X.shape[2]))
+
+def _reverse_valid(X, mask):
+    # reverses every sample in time within its length, padding stays zero at the end
+    lengths = T.cast(T.sum(mask, axis=0), 'int64')
+    steps = T.maximum(lengths.dimshuffle('x', 0) - 1 - T.arange(X.shape[0]).dimshuffle(0, 'x'), 0)
+    return _gather_steps(X, steps) * mask.dimshuffle(0, 1, 'x')
+
+def _last_valid(X, mask):
+    lengths = T.cast(T.sum(mask, axis=0), 'int64')
+    return _gather_steps(X, T.maximum(lengths - 1, 0).dimshuffle('x', 0))[0]
+
+# Unrolling: with unroll=True the recurrence is max_length copies of the step
+# in one static graph instead of a scan, which saves the per-step overhead of
+# scan and lets the graph optimizer work across steps. Inputs are padded to
+# max_length steps and the outputs cut back to the real length, so shorter
+# batches give the same result as the scan.
+_assert_max_length = Assert('sequence longer than max_length of an unrolled layer')
+
+def _check_unroll(unroll, max_length, truncate_gradient):
+    # max_length counts the sequence steps, not the entity vector
+    if unroll and max_length is None:
+        raise Exception('unroll=True needs max_length')
+    if unroll and truncate_gradient != -1:
+        raise Exception('An unrolled layer does not truncate gradients')
+
+def _pad_steps(X, nb_steps):
+    # (time, nb_samples, dim) -> (nb_steps, nb_samples, dim), zeros after the last step
+    X = _assert_max_length(X, T.le(X.shape[0], nb_steps))
+    return T.set_subtensor(T.zeros((nb_steps, X.shape[1], X.shape[2]), dtype=X.dtype)[:X.shape[0]], X)
+
+def _recurrence(fn, sequences, outputs_info, non_sequences, truncate_gradient=-1,
+                go_backwards=False, nb_steps=None):
+    '''
+        theano.scan, or with nb_steps the same recurrence unrolled over
+        nb_steps steps of the sequences. Returns (outputs, updates) as scan.
+    '''
+    if nb_steps is None:
+        return theano.scan(fn, sequences=sequences, outputs_info=outputs_info,
+            non_sequences=non_sequences, truncate_gradient=truncate_gradient,
+            go_backwards=go_backwards)
+    if type(sequences) not in (list, tuple):
+        sequences = [sequences]
+    if type(non_sequences) not in (list, tuple):
+        non_sequences = [non_sequences]
+    single = type(outputs_info) not in (list, tuple)
+    states = [outputs_info] if single else list(outputs_info)
+    if go_backwards:
+        sequences = [seq[::-1] for seq in sequences]
+    steps = [[] for state in states]
+    for t in range(nb_steps):
+        states = fn(*([seq[t] for seq in sequences] + states + list(non_sequences)))
+        if type(states) not in (list, tuple):
+            states = [states]
+        states = list(states)
+        for k, state in enumerate(states):
+            steps[k].append(state)
+    outputs = [T.stack(*step) for step in steps]
+    if single:
+        return outputs[0], {}
+    return outputs, {}
+
 
 class BLSTM(Layer):
     def __init__(self, input_dim, output_dim,
         init='glorot_uniform', inner_init='orthogonal',
         activation='tanh', inner_activation='hard_sigmoid',
         weights=None, truncate_gradient=-1, return_sequences=False,
-        is_entity=False, regularize=False):
+        is_entity=False, regularize=False, mask_zero=False, unroll=False, max_length=None):
 
         self.is_entity = is_entity
+        # treat all-zero input vectors as end padding, see _zero_mask
+        self.mask_zero = mask_zero
+        # static graph of max_length steps, see _recurrence
+        _check_unroll(unroll, max_length, truncate_gradient)
+        self.unroll = unroll
+        self.max_length = max_length
         self.input_dim = input_dim
         self.output_dim = output_dim
         self.truncate_gradient = truncate_gradient
         self.return_sequences = return_sequences
+        # when True the input holds precomputed gate projections, see project_inputs
+        self.precomputed_input = False
 
         self.init = initializations.get(init)
         self.inner_init = initializations.get(inner_init)
@@ -31,6 +114,16 @@ class BLSTM(Layer):
         self.inner_activation = activations.get(inner_activation)
         self.input = T.tensor3()
 
+        self.init_params()
+        if regularize:
+            self.regularizers = []
+            for i in self.params:
+                self.regularizers.append(regularizers.my_l2)
+
+        if weights is not None:
+            self.set_weights(weights)
+
+    def init_params(self):
         self.W_if = self.init((self.input_dim, self.output_dim))
         self.W_ib = self.init((self.input_dim, self.output_dim))
         self.U_if = self.inner_init((self.output_dim, self.output_dim))
@@ -80,13 +173,6 @@ class BLSTM(Layer):
             self.W_yf, self.W_yb, self.b_y
             #self.W_y, self.b_y
         ]
-        if regularize:
-            self.regularizers = []
-            for i in self.params:
-                self.regularizers.append(regularizers.my_l2)
-
-        if weights is not None:
-            self.set_weights(weights)
 
     def _step(self,
         xi_t, xf_t, xo_t, xc_t,
@@ -99,6 +185,33 @@ class BLSTM(Layer):
         h_t = o_t * self.activation(c_t)
         return h_t, c_t
 
+    def gate_weights(self):
+        '''
+            Input weights and biases of the 8 gates stacked as
+            (input_dim, 8*output_dim) and (8*output_dim,), in the order
+            i, f, o, c of the forward then of the backward direction.
+        '''
+        W = np.concatenate([w.get_value() for w in [
+            self.W_if, self.W_ff, self.W_of, self.W_cf,
+            self.W_ib, self.W_fb, self.W_ob, self.W_cb]], axis=1)
+        b = np.concatenate([v.get_value() for v in [
+            self.b_if, self.b_ff, self.b_of, self.b_cf,
+            self.b_ib, self.b_fb, self.b_ob, self.b_cb]])
+        return W, b
+
+    def project_inputs(self, X, batch_size=4096):
+        '''
+            Gate input projections X.W + b of a (nb_vectors, input_dim) matrix,
+            as a contiguous (nb_vectors, 8*output_dim) float array.
+            Rows of it can be fed to the layer instead of X when
+            precomputed_input is set, so only the recurrence runs per sequence.
+        '''
+        W, b = self.gate_weights()
+        projections = np.empty((len(X), W.shape[1]), dtype=theano.config.floatX)
+        for start in range(0, len(X), batch_size):
+            projections[start:start+batch_size] = np.dot(X[start:start+batch_size], W) + b
+        return projections
+
     def output(self, train):
         X = self.get_input(train)
         X = X.dimshuffle((1,0,2))
@@ -107,23 +220,66 @@ class BLSTM(Layer):
         if self.is_entity:
             Entity = X[-1:].dimshuffle(1,0,2)
             X = X[:-1]
+            if self.precomputed_input:
+                # the entity vector is stored in the first input_dim columns
+                Entity = Entity[:, :, :self.input_dim]
+
+        nb_steps = X.shape[0]
+        if self.unroll:
+            X = _pad_steps(X, self.max_length)
+
+        # precomputed gate projections are not zero on padding, they are not masked
+        mask = None
+        if self.mask_zero and not self.precomputed_input:
+            mask = _zero_mask(X)
+
+        outputs_f, outputs_b = self._directions(X)
+        if self.unroll:
+            outputs_f, outputs_b = outputs_f[:nb_steps], outputs_b[:nb_steps]
+            if mask is not None:
+                mask = mask[:nb_steps]
+        if self.return_sequences:
+            if mask is None:
+                outputs_b = outputs_b[::-1]
+            else:
+                outputs_b = _reverse_valid(outputs_b, mask)
+            # both directions in one product, the bias broadcast over samples and time
+            h = T.concatenate([outputs_f, outputs_b], axis=2).dimshuffle((1,0,2))
+            y = T.tensordot(h, T.concatenate([self.W_yf, self.W_yb]), [[2],[0]]) + self.b_y.dimshuffle('x', 'x', 0)
+            if mask is not None:
+                y = y * mask.dimshuffle(1, 0, 'x')
+            # y = T.add(T.tensordot(
+            #     T.add(outputs_f.dimshuffle((1, 0, 2)),
+            #           outputs_b[::-1].dimshuffle((1,0,2))),
+            #     self.W_y,[[2],[0]]),self.b_y)
+            if self.is_entity:
+                return T.concatenate([y, Entity], axis=1)
+            else:
+                return y
+        if mask is not None:
+            return T.concatenate((_last_valid(outputs_f, mask), outputs_b[0]))
+        return T.concatenate((outputs_f[-1], outputs_b[0]))
 
-        b_y = self.b_y
-        b_yn = T.repeat(T.repeat(b_y.reshape((1,self.output_dim)),X.shape[0],axis=0).reshape((1,X.shape[0],self.output_dim)), X.shape[1], axis=0)
-
-        xif = T.dot(X, self.W_if) + self.b_if
-        xib = T.dot(X, self.W_ib) + self.b_ib
+    def _directions(self, X):
+        # (time, nb_samples, output_dim) outputs of the forward and the backward
+        # direction; both read X in the same order, output reverses the backward one
+        if self.precomputed_input:
+            n = self.output_dim
+            xif, xff, xof, xcf, xib, xfb, xob, xcb = [X[:, :, k*n:(k+1)*n] for k in range(8)]
+        else:
+            xif = T.dot(X, self.W_if) + self.b_if
+            xib = T.dot(X, self.W_ib) + self.b_ib
 
-        xff = T.dot(X, self.W_ff) + self.b_ff
-        xfb = T.dot(X, self.W_fb) + self.b_fb
+            xff = T.dot(X, self.W_ff) + self.b_ff
+            xfb = T.dot(X, self.W_fb) + self.b_fb
 
-        xcf = T.dot(X, self.W_cf) + self.b_cf
-        xcb = T.dot(X, self.W_cb) + self.b_cb
+            xcf = T.dot(X, self.W_cf) + self.b_cf
+            xcb = T.dot(X, self.W_cb) + self.b_cb
 
-        xof = T.dot(X, self.W_of) + self.b_of
-        xob = T.dot(X, self.W_ob) + self.b_ob
+            xof = T.dot(X, self.W_of) + self.b_of
+            xob = T.dot(X, self.W_ob) + self.b_ob
 
-        [outputs_f, memories_f], updates_f = theano.scan(
+        [outputs_f, memories_f], updates_f = _recurrence(
             self._step,
             sequences=[xif, xff, xof, xcf],
             outputs_info=[
@@ -131,9 +287,10 @@ class BLSTM(Layer):
                 alloc_zeros_matrix(X.shape[1], self.output_dim)
             ],
             non_sequences=[self.U_if, self.U_ff, self.U_of, self.U_cf],
-            truncate_gradient=self.truncate_gradient
+            truncate_gradient=self.truncate_gradient,
+            nb_steps=self.max_length if self.unroll else None
         )
-        [outputs_b, memories_b], updates_b = theano.scan(
+        [outputs_b, memories_b], updates_b = _recurrence(
             self._step,
             sequences=[xib, xfb, xob, xcb],
             outputs_info=[
@@ -141,22 +298,10 @@ class BLSTM(Layer):
                 alloc_zeros_matrix(X.shape[1], self.output_dim)
             ],
             non_sequences=[self.U_ib, self.U_fb, self.U_ob, self.U_cb],
-            truncate_gradient=self.truncate_gradient
+            truncate_gradient=self.truncate_gradient,
+            nb_steps=self.max_length if self.unroll else None
         )
-        if self.return_sequences:
-            y = T.add(T.add(
-                    T.tensordot(outputs_f.dimshuffle((1,0,2)), self.W_yf, [[2],[0]]),
-                    T.tensordot(outputs_b[::-1].dimshuffle((1,0,2)), self.W_yb, [[2],[0]])),
-                b_yn)
-            # y = T.add(T.tensordot(
-            #     T.add(outputs_f.dimshuffle((1, 0, 2)),
-            #           outputs_b[::-1].dimshuffle((1,0,2))),
-            #     self.W_y,[[2],[0]]),b_yn)
-            if self.is_entity:
-                return T.concatenate([y, Entity], axis=1)
-            else:
-                return y
-        return T.concatenate((outputs_f[-1], outputs_b[0]))
+        return outputs_f, outputs_b
 
     def get_config(self):
         return {"name":self.__class__.__name__,
@@ -166,7 +311,132 @@ class BLSTM(Layer):
             "inner_init":self.inner_init.__name__,
             "activation":self.activation.__name__,
             "truncate_gradient":self.truncate_gradient,
-            "return_sequences":self.return_sequences}
+            "return_sequences":self.return_sequences,
+            "mask_zero":self.mask_zero,
+            "unroll":self.unroll,
+            "max_length":self.max_length}
+
+
+# legacy BLSTM params of one direction, in fused gate order i, f, o, c
+_blstm_gate_params = {
+    'f': [(0, 1, 2), (12, 13, 14), (18, 19, 20), (6, 7, 8)],
+    'b': [(3, 4, 5), (15, 16, 17), (21, 22, 23), (9, 10, 11)],
+}
+
+def fuse_blstm_weights(weights):
+    '''
+        The 27 BLSTM weights (BLSTM.params order) as the 9 FusedBLSTM weights:
+        W, U, b of the forward then of the backward direction with the
+        gates concatenated, then W_yf, W_yb, b_y.
+    '''
+    weights = [np.asarray(w) for w in weights]
+    if len(weights) != 27:
+        raise Exception('BLSTM expects 27 weights, got ' + str(len(weights)))
+    fused = []
+    for direction in ['f', 'b']:
+        gates = _blstm_gate_params[direction]
+        fused.append(np.concatenate([weights[w] for w, u, b in gates], axis=1))
+        fused.append(np.concatenate([weights[u] for w, u, b in gates], axis=1))
+        fused.append(np.concatenate([weights[b] for w, u, b in gates]))
+    return fused + weights[24:]
+
+def unfuse_blstm_weights(weights):
+    # inverse of fuse_blstm_weights, for checkpoints read by BLSTM
+    weights = [np.asarray(w) for w in weights]
+    legacy = [None] * 24
+    for k, direction in enumerate(['f', 'b']):
+        W, U, b = weights[3*k:3*k+3]
+        n = U.shape[0]
+        for g, (w, u, v) in enumerate(_blstm_gate_params[direction]):
+            legacy[w] = W[:, g*n:(g+1)*n]
+            legacy[u] = U[:, g*n:(g+1)*n]
+            legacy[v] = b[g*n:(g+1)*n]
+    return legacy + weights[6:]
+
+
+class FusedBLSTM(BLSTM):
+    '''
+        BLSTM with the 4 gates of a direction in one (input_dim, 4*output_dim)
+        input matrix and one (output_dim, 4*output_dim) recurrent matrix.
+        Both directions run in one scan over a stacked (2, nb_samples, output_dim)
+        state, so a timestep is one batched product instead of 8 small ones.
+        Computes the same function as BLSTM, whose options and output it
+        shares; its 27-weight checkpoints are converted by set_weights.
+    '''
+    def init_params(self):
+        # gates are initialized one by one, as in BLSTM, then concatenated
+        def gates(init, shape):
+            return sharedX(np.concatenate([init(shape).get_value() for g in range(4)], axis=1))
+
+        self.W_f = gates(self.init, (self.input_dim, self.output_dim))
+        self.U_f = gates(self.inner_init, (self.output_dim, self.output_dim))
+        self.b_f = shared_zeros((4*self.output_dim))
+        self.W_b = gates(self.init, (self.input_dim, self.output_dim))
+        self.U_b = gates(self.inner_init, (self.output_dim, self.output_dim))
+        self.b_b = shared_zeros((4*self.output_dim))
+
+        self.W_yf = self.init((self.output_dim, self.output_dim))
+        self.W_yb = self.init((self.output_dim, self.output_dim))
+        self.b_y = shared_zeros((self.output_dim))
+
+        self.params = [
+            self.W_f, self.U_f, self.b_f,
+            self.W_b, self.U_b, self.b_b,
+            self.W_yf, self.W_yb, self.b_y
+        ]
+
+    def set_weights(self, weights):
+        # also takes the 27 weights of a BLSTM (crcn_*.hdf5, rcn_*.hdf5)
+        if len(weights) == 27:
+            weights = fuse_blstm_weights(weights)
+        super(FusedBLSTM, self).set_weights(weights)
+
+    def get_legacy_weights(self):
+        return unfuse_blstm_weights(self.get_weights())
+
+    def _step(self, x_t, h_tm1, c_tm1, u):
+        # x_t: (2, nb_samples, 4*output_dim), h_tm1, c_tm1: (2, nb_samples, output_dim)
+        n = self.output_dim
+        z = x_t + T.batched_dot(h_tm1, u)
+        i_t = self.inner_activation(z[:, :, :n])
+        f_t = self.inner_activation(z[:, :, n:2*n])
+        o_t = self.inner_activation(z[:, :, 2*n:3*n])
+        c_t = f_t * c_tm1 + i_t * self.activation(z[:, :, 3*n:])
+        h_t = o_t * self.activation(c_t)
+        return h_t, c_t
+
+    def gate_weights(self):
+        '''
+            Same layout as BLSTM.gate_weights: (input_dim, 8*output_dim) and
+            (8*output_dim,), gates i, f, o, c of the forward then of the
+            backward direction.
+        '''
+        W = np.concatenate([self.W_f.get_value(), self.W_b.get_value()], axis=1)
+        b = np.concatenate([self.b_f.get_value(), self.b_b.get_value()])
+        return W, b
+
+    def _directions(self, X):
+        if self.precomputed_input:
+            x = X
+        else:
+            x = T.dot(X, T.concatenate([self.W_f, self.W_b], axis=1)) + T.concatenate([self.b_f, self.b_b])
+        # (time, nb_samples, 8*output_dim) -> (time, 2, nb_samples, 4*output_dim)
+        x = x.reshape((x.shape[0], x.shape[1], 2, 4*self.output_dim)).dimshuffle(0, 2, 1, 3)
+
+        # like BLSTM, the backward direction reads the sequence in the same
+        # order and its outputs are reversed in time
+        [outputs, memories], updates = _recurrence(
+            self._step,
+            sequences=x,
+            outputs_info=[
+                T.unbroadcast(T.alloc(np.cast[theano.config.floatX](0.), 2, X.shape[1], self.output_dim), 0),
+                T.unbroadcast(T.alloc(np.cast[theano.config.floatX](0.), 2, X.shape[1], self.output_dim), 0)
+            ],
+            non_sequences=T.stack([self.U_f, self.U_b]),
+            truncate_gradient=self.truncate_gradient,
+            nb_steps=self.max_length if self.unroll else None
+        )
+        return outputs[:, 0], outputs[:, 1]
 
 
 class BRNN(Layer):
@@ -177,9 +447,16 @@ class BRNN(Layer):
     '''
     def __init__(self, input_dim, output_dim,
         init='uniform', inner_init='orthogonal', activation='sigmoid', weights=None,
-        truncate_gradient=-1,  return_sequences=False, is_entity=False, regularize=False):
+        truncate_gradient=-1,  return_sequences=False, is_entity=False, regularize=False,
+        mask_zero=False, unroll=False, max_length=None):
         #whyjay
         self.is_entity = is_entity
+        # treat all-zero input vectors as end padding, see _zero_mask
+        self.mask_zero = mask_zero
+        # static graph of max_length steps, see _recurrence
+        _check_unroll(unroll, max_length, truncate_gradient)
+        self.unroll = unroll
+        self.max_length = max_length
 
         self.init = initializations.get(init)
         self.inner_init = initializations.get(inner_init)
@@ -222,37 +499,68 @@ class BRNN(Layer):
             Entity=X[lenX-1:].dimshuffle(1,0,2)
             X=X[:lenX-1]
 
+        nb_steps = X.shape[0]
+        if self.unroll:
+            X = _pad_steps(X, self.max_length)
+
+        mask = None
+        if self.mask_zero:
+            mask = _zero_mask(X)
+
         xf = self.activation(T.dot(X, self.W_if) + self.b_if)
         xb = self.activation(T.dot(X, self.W_ib) + self.b_ib)
-        b_o=self.b_o
-        b_on= T.repeat(T.repeat(b_o.reshape((1,self.output_dim)),X.shape[0],axis=0).reshape((1,X.shape[0],self.output_dim)),X.shape[1],axis=0)
+        go_backwards = True
+        if mask is not None:
+            # the backward pass starts at the last valid step of every sample:
+            # reverse within the lengths and scan forward
+            xb = _reverse_valid(xb, mask)
+            go_backwards = False
+        elif self.unroll:
+            # the backward pass starts at the last step, not at the padding
+            xb = _pad_steps(xb[:nb_steps][::-1], self.max_length)
+            go_backwards = False
 
         # Iterate forward over the first dimension of the x array (=time).
-        outputs_f, updates_f = theano.scan(
+        outputs_f, updates_f = _recurrence(
             self._step,  # this will be called with arguments (sequences[i], outputs[i-1], non_sequences[i])
             sequences=xf,  # tensors to iterate over, inputs to _step
             # initialization of the output. Input to _step with default tap=-1.
             outputs_info=alloc_zeros_matrix(X.shape[1], self.output_dim),
             non_sequences=[self.W_ff,self.b_f],  # static inputs to _step
-            truncate_gradient=self.truncate_gradient
+            truncate_gradient=self.truncate_gradient,
+            nb_steps=self.max_length if self.unroll else None
         )
         # Iterate backward over the first dimension of the x array (=time).
-        outputs_b, updates_b = theano.scan(
+        outputs_b, updates_b = _recurrence(
             self._step,  # this will be called with arguments (sequences[i], outputs[i-1], non_sequences[i])
             sequences=xb,  # tensors to iterate over, inputs to _step
             # initialization of the output. Input to _step with default tap=-1.
             outputs_info=alloc_zeros_matrix(X.shape[1], self.output_dim),
             non_sequences=[self.W_bb,self.b_b],  # static inputs to _step
             truncate_gradient=self.truncate_gradient,
-            go_backwards=True  # Iterate backwards through time
+            go_backwards=go_backwards,  # Iterate backwards through time
+            nb_steps=self.max_length if self.unroll else None
         )
+        if self.unroll:
+            outputs_f, outputs_b = outputs_f[:nb_steps], outputs_b[:nb_steps]
+            if mask is not None:
+                mask = mask[:nb_steps]
         #return outputs_f.dimshuffle((1, 0, 2))
         if self.return_sequences:
+            if mask is None:
+                outputs_b = outputs_b[::-1]
+            else:
+                outputs_b = _reverse_valid(outputs_b, mask)
+            y = T.add(T.tensordot(T.add(outputs_f.dimshuffle((1, 0, 2)), outputs_b.dimshuffle((1,0,2))),self.W_o,[[2],[0]]),self.b_o.dimshuffle('x', 'x', 0))
+            if mask is not None:
+                y = y * mask.dimshuffle(1, 0, 'x')
             if self.is_entity:
-                return T.concatenate([T.add(T.tensordot(T.add(outputs_f.dimshuffle((1, 0, 2)), outputs_b[::-1].dimshuffle((1,0,2))),self.W_o,[[2],[0]]),b_on),Entity],axis=1)
+                return T.concatenate([y,Entity],axis=1)
             else:
-                return T.add(T.tensordot(T.add(outputs_f.dimshuffle((1, 0, 2)), outputs_b[::-1].dimshuffle((1,0,2))),self.W_o,[[2],[0]]),b_on)
+                return y
 
+        if mask is not None:
+            return T.concatenate((_last_valid(outputs_f, mask), outputs_b[0]))
         return T.concatenate((outputs_f[-1], outputs_b[0]))
 
     def get_config(self):
@@ -263,5 +571,8 @@ class BRNN(Layer):
             "inner_init":self.inner_init.__name__,
             "activation":self.activation.__name__,
             "truncate_gradient":self.truncate_gradient,
-            "return_sequences":self.return_sequences}
+            "return_sequences":self.return_sequences,
+            "mask_zero":self.mask_zero,
+            "unroll":self.unroll,
+            "max_length":self.max_length}
 
@@ -23,6 +23,49 @@ def make_batches(size, batch_size):
     nb_batch = int(np.ceil(size/float(batch_size)))
     return [(i*batch_size, min(size, (i+1)*batch_size)) for i in range(0, nb_batch)]
 
+def sequence_lengths(X, keep_trailing=0):
+    '''
+        Number of timesteps of every sample of X (nb_samples, time, ...)
+        before its end padding of all-zero vectors. The last keep_trailing
+        timesteps (e.g. the CRCN entity vector) are not counted.
+    '''
+    steps = np.asarray(X)[:, :X.shape[1]-keep_trailing]
+    valid = np.abs(steps).reshape(steps.shape[:2] + (-1,)).sum(axis=2) != 0
+    return np.where(valid.any(axis=1), valid.shape[1] - np.argmax(valid[:, ::-1], axis=1), 0)
+
+def make_length_batches(lengths, batch_size, bucket_batches, shuffle=True):
+    '''
+        Index arrays of batches of samples of similar lengths: samples are
+        sorted by length within pools of bucket_batches batches (shuffled
+        first when shuffle is set), then the batches are shuffled.
+    '''
+    if shuffle:
+        index_array = np.random.permutation(len(lengths))
+    else:
+        index_array = np.arange(len(lengths))
+    pool_size = batch_size * bucket_batches
+    batches = []
+    for pool_start in range(0, len(index_array), pool_size):
+        pool = index_array[pool_start:pool_start+pool_size]
+        pool = pool[np.argsort(lengths[pool], kind='mergesort')]
+        batches += [pool[batch_start:batch_end] for batch_start, batch_end in make_batches(len(pool), batch_size)]
+    if shuffle:
+        np.random.shuffle(batches)
+    return batches
+
+def trim_padding(X, y, maxlen, keep_trailing=0):
+    '''
+        Drops the padding timesteps past maxlen of a batch, keeping the last
+        keep_trailing timesteps of X. 3-D targets lose as many timesteps.
+    '''
+    cut = X.shape[1] - keep_trailing - max(maxlen, 1)
+    if cut <= 0:
+        return X, y
+    X = np.concatenate([X[:, :X.shape[1]-keep_trailing-cut], X[:, X.shape[1]-keep_trailing:]], axis=1)
+    if y.ndim == 3:
+        y = y[:, :y.shape[1]-cut]
+    return X, y
+
 def ndim_tensor(ndim):
     if ndim == 2:
         return T.matrix()
@@ -68,7 +111,11 @@ class Sequential(object):
             self.constraints += [constraints.identity for _ in range(len(layer.params))]
 
 
-    def compile(self, optimizer, loss, class_mode="categorical", y_dim_components=1):
+    def compile(self, optimizer, loss, class_mode="categorical", y_dim_components=1, score=None):
+        '''
+            @param score: optional per-sample objective (e.g. 'crcn_score_vec_func')
+                returning one value per sample, used by score_samples
+        '''
         self.optimizer = optimizers.get(optimizer)
         self.loss = objectives.get(loss)
         # input of model
@@ -111,6 +158,15 @@ class Sequential(object):
             allow_input_downcast=True)
         self._test_with_acc = theano.function([self.X, self.y], [test_score, test_accuracy],
             allow_input_downcast=True)
+        if score is not None:
+            self.score_objective = objectives.get(score)
+            self._score = theano.function([self.X, self.y], self.score_objective(self.y, self.y_test),
+                allow_input_downcast=True)
+            # one target sequence shared by the whole batch, broadcast inside the graph
+            self.y_query = T.matrix()
+            self._score_query = theano.function([self.X, self.y_query],
+                self.score_objective(self.y_query.dimshuffle('x', 0, 1), self.y_test),
+                allow_input_downcast=True)
         print ("compile end")
     def train(self, X, y, accuracy=False):
         y = standardize_y(y)
@@ -128,8 +184,43 @@ class Sequential(object):
             return self._test(X, y)
 
 
+    def score_samples(self, X, y, batch_size=128):
+        '''
+            Score every sample with the per-sample objective given to compile(score=...).
+            Samples are sent in chunks of batch_size; returns a (nb_samples,) array.
+        '''
+        if not hasattr(self, '_score'):
+            raise Exception("No per-sample score objective; compile the model with score=...")
+        scores = np.zeros((len(X),))
+        for batch_start, batch_end in make_batches(len(X), batch_size):
+            scores[batch_start:batch_end] = self._score(X[batch_start:batch_end], y[batch_start:batch_end])
+        return scores
+
+    def score_query(self, X, y_seq, batch_size=128):
+        '''
+            Score every sample of X against the same target sequence y_seq
+            (vector nb, dimension) without replicating it per sample.
+            Returns a (nb_samples,) array.
+        '''
+        if not hasattr(self, '_score_query'):
+            raise Exception("No per-sample score objective; compile the model with score=...")
+        scores = np.zeros((len(X),))
+        for batch_start, batch_end in make_batches(len(X), batch_size):
+            scores[batch_start:batch_end] = self._score_query(X[batch_start:batch_end], y_seq)
+        return scores
+
+
     def fit(self, X, y, batch_size=128, nb_epoch=100, verbose=1,
-            validation_split=0., validation_data=None, shuffle=True, show_accuracy=False):
+            validation_split=0., validation_data=None, shuffle=True, show_accuracy=False,
+            bucket_batches=None, keep_trailing=0):
+        '''
+            @param bucket_batches: for sequences zero padded at the end, batch
+                samples of similar length (see make_length_batches, pools of
+                bucket_batches batches) and run every batch only up to its
+                longest sequence. Use with mask_zero layers and masked objectives.
+            @param keep_trailing: timesteps at the end of X that are not part of
+                the sequence and are kept when a batch is trimmed (1 for CRCN)
+        '''
         y = standardize_y(y)
 
         do_validation = False
@@ -154,22 +245,29 @@ class Sequential(object):
                 if verbose:
                     print("Train on %d samples, validate on %d samples" % (len(y), len(y_val)))
 
+        if bucket_batches:
+            lengths = sequence_lengths(X, keep_trailing)
         index_array = np.arange(len(X))
         for epoch in range(nb_epoch):
             if verbose:
                 print('Epoch', epoch)
                 progbar = Progbar(target=len(X), verbose=verbose)
-            if shuffle:
-                np.random.shuffle(index_array)
 
-            batches = make_batches(len(X), batch_size)
-            for batch_index, (batch_start, batch_end) in enumerate(batches):
+            if bucket_batches:
+                batches = make_length_batches(lengths, batch_size, bucket_batches, shuffle)
+            else:
                 if shuffle:
-                    batch_ids = index_array[batch_start:batch_end]
+                    np.random.shuffle(index_array)
+                    batches = [index_array[batch_start:batch_end] for batch_start, batch_end in make_batches(len(X), batch_size)]
                 else:
-                    batch_ids = slice(batch_start, batch_end)
+                    batches = [slice(batch_start, batch_end) for batch_start, batch_end in make_batches(len(X), batch_size)]
+            batch_end = 0
+            for batch_index, batch_ids in enumerate(batches):
                 X_batch = X[batch_ids]
                 y_batch = y[batch_ids]
+                if bucket_batches:
+                    X_batch, y_batch = trim_padding(X_batch, y_batch, lengths[batch_ids].max(), keep_trailing)
+                batch_end += len(X_batch)
 
                 if show_accuracy:
                     loss, acc = self._train_with_acc(X_batch, y_batch)
@@ -2,11 +2,14 @@ from __future__ import absolute_import
 import theano
 import theano.tensor as T
 import numpy as np
+from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+from theano.gradient import disconnected_grad
 from six.moves import range
 
 epsilon = 1.0e-15
 
-def rcn_cost_func(y_true, y_pred):
+def rcn_scan_cost_func(y_true, y_pred):
+    # reference version of rcn_cost_func, one scan step per (k, j) pair
     # y_pred = (batch nb, vector nb,  dimension)
     # y_true = image vector = (batch nb, vector nb,  dimension)
     ypred_copy=y_pred
@@ -31,7 +34,8 @@ def rcn_cost_func(y_true, y_pred):
     (sumscores,updates)=theano.scan(fn=iter_k,sequences=[y_pred,y_true],non_sequences=[ytrue_copy,ypred_copy])
     return T.sum(sumscores)
 
-def crcn_cost_func(y_true, y_pred):
+def crcn_scan_cost_func(y_true, y_pred):
+    # reference version of crcn_cost_func, one scan step per (k, j) pair
     # y_pred = (batch nb, vector nb,  dimension)
     # y_true = image vector = (batch nb, vector nb,  dimension)
     ypred_copy=y_pred
@@ -63,6 +67,148 @@ def crcn_cost_func(y_true, y_pred):
     (sumscores,updates)=theano.scan(fn=iter_k,sequences=[y_pred,y_true],non_sequences=[ytrue_copy,ypred_copy])
     return T.sum(sumscores)
 
+# In-batch ranking loss. With S[k, j] = seq_score(out_k, img_j) and the
+# positive score d[k] = S[k, k], the scan versions sum over every (k, j)
+#   max(0, S[k, j] + 1 - d[k]) + max(0, S[j, k] + 1 - d[k])
+# Both terms are hinges of the same matrix S, once against the positive of
+# its row and once against the positive of its column, so the whole loss is
+# one matrix product and two broadcast hinges.
+RANKING_BLOCK_SIZE = None
+
+def _alignment_operands(y_true, y_pred, masked=False):
+    '''
+        (batch nb, seq_len * dimension) matrices whose dot product is the
+        diagonal alignment, and the (batch nb,) sequence lengths it is
+        normalized by, min(len) as T.eye(out_len,img_len)/T.sum(eye).
+        masked: all-zero image vectors are end padding, a sample has its own
+        length and the alignment of a pair is normalized by the shorter one.
+    '''
+    seq_len = T.minimum(y_pred.shape[1], y_true.shape[1])
+    out = y_pred[:, :seq_len]
+    img = y_true[:, :seq_len]
+    if masked:
+        mask = T.cast(T.neq(T.sum(T.abs_(img), axis=2), 0), theano.config.floatX)
+        out = out * mask.dimshuffle(0, 1, 'x')
+        lengths = T.maximum(T.sum(mask, axis=1), 1)
+    else:
+        lengths = T.cast(T.alloc(seq_len, y_true.shape[0]), theano.config.floatX)
+    return out.flatten(2), img.flatten(2), lengths
+
+def _pair_scale(lengths_k, lengths_j):
+    # 1/min(len_k, len_j) of every pair, lengths_j broadcast against lengths_k
+    return 1. / T.minimum(lengths_k, lengths_j)
+
+def _ranking_hinge_loss(out_flat, img_flat, lengths, entity=None, img_sum=None, block_size=None):
+    # entity, img_sum: (batch nb, dimension) entity vectors and image sums,
+    # adding entity_k . sum(img_j) to S[k, j] as crcn seq_score does
+    positive = T.sum(out_flat * img_flat, axis=1) / lengths
+    if entity is not None:
+        positive += T.sum(entity * img_sum, axis=1)
+
+    def block_loss(rows):
+        scores = T.dot(out_flat[rows], img_flat.T) * _pair_scale(lengths[rows].dimshuffle(0, 'x'), lengths.dimshuffle('x', 0))
+        if entity is not None:
+            scores += T.dot(entity[rows], img_sum.T)
+        margin = scores + 1.
+        return T.sum(T.maximum(0, margin - positive[rows].dimshuffle(0, 'x'))) + \
+            T.sum(T.maximum(0, margin - positive.dimshuffle('x', 0)))
+
+    if block_size is None:
+        return block_loss(slice(None))
+    # row blocks of S, so only block_size x batch nb scores are alive at once
+    batch_nb = out_flat.shape[0]
+    def iter_block(start):
+        return block_loss(slice(start, T.minimum(start + block_size, batch_nb)))
+    (block_losses, updates) = theano.scan(fn=iter_block, sequences=[T.arange(0, batch_nb, block_size)])
+    return T.sum(block_losses)
+
+def rcn_cost_func(y_true, y_pred, masked=False):
+    # y_pred = (batch nb, vector nb,  dimension)
+    # y_true = image vector = (batch nb, vector nb,  dimension)
+    out_flat, img_flat, lengths = _alignment_operands(y_true, y_pred, masked)
+    return _ranking_hinge_loss(out_flat, img_flat, lengths, block_size=RANKING_BLOCK_SIZE)
+
+def crcn_cost_func(y_true, y_pred, masked=False):
+    # y_pred = (batch nb, vector nb + 1,  dimension), last vector is the entity vector
+    # y_true = image vector = (batch nb, vector nb,  dimension)
+    out_flat, img_flat, lengths = _alignment_operands(y_true, y_pred[:, :-1], masked)
+    return _ranking_hinge_loss(out_flat, img_flat, lengths, y_pred[:, -1], T.sum(y_true, axis=1),
+                               block_size=RANKING_BLOCK_SIZE)
+
+def rcn_masked_cost_func(y_true, y_pred):
+    # rcn_cost_func of sequences zero padded at the end, every pair aligned on its own length
+    return rcn_cost_func(y_true, y_pred, masked=True)
+
+def crcn_masked_cost_func(y_true, y_pred):
+    # crcn_cost_func of sequences zero padded at the end, entity vector last
+    return crcn_cost_func(y_true, y_pred, masked=True)
+
+# Sampled negatives: instead of every j of the batch, each positive k is
+# compared with nb_negatives images (row k of S) and nb_negatives sentence
+# sequences (column k of S). 'uniform' draws them at random among j != k,
+# 'hard' takes the highest scoring ones. Only the B x nb_negatives sampled
+# scores carry a gradient; hard mining still ranks the full S, without
+# gradient, to choose them.
+def _negative_indices(out_flat, img_flat, lengths, entity, img_sum, nb_negatives, mining, rng):
+    batch_nb = out_flat.shape[0]
+    if mining == 'uniform':
+        # offsets in 1..batch nb-1, so j != k whenever the batch has 2 samples
+        offsets = 1 + T.cast(T.floor(rng.uniform((batch_nb, nb_negatives)) * (batch_nb - 1)), 'int64')
+        negatives = (T.arange(batch_nb).dimshuffle(0, 'x') + offsets) % batch_nb
+        return negatives, negatives
+    if mining == 'hard':
+        scores = T.dot(out_flat, img_flat.T) * _pair_scale(lengths.dimshuffle(0, 'x'), lengths.dimshuffle('x', 0))
+        if entity is not None:
+            scores += T.dot(entity, img_sum.T)
+        scores = disconnected_grad(T.fill_diagonal(scores, -np.inf))
+        start = batch_nb - T.minimum(nb_negatives, batch_nb - 1)
+        return T.argsort(scores, axis=1)[:, start:], T.argsort(scores, axis=0)[start:].T
+    raise Exception('Invalid negative mining: ' + str(mining))
+
+def _sampled_hinge_loss(out_flat, img_flat, lengths, entity=None, img_sum=None,
+                        nb_negatives=10, mining='uniform', rng=None):
+    img_neg, sent_neg = _negative_indices(out_flat, img_flat, lengths, entity, img_sum, nb_negatives, mining, rng)
+    positive = T.sum(out_flat * img_flat, axis=1) / lengths
+    # S[k, img_neg[k, n]] and S[sent_neg[k, n], k], (batch nb, nb_negatives)
+    img_scores = T.sum(out_flat.dimshuffle(0, 'x', 1) * img_flat[img_neg], axis=2) * \
+        _pair_scale(lengths.dimshuffle(0, 'x'), lengths[img_neg])
+    sent_scores = T.sum(out_flat[sent_neg] * img_flat.dimshuffle(0, 'x', 1), axis=2) * \
+        _pair_scale(lengths.dimshuffle(0, 'x'), lengths[sent_neg])
+    if entity is not None:
+        positive += T.sum(entity * img_sum, axis=1)
+        img_scores += T.sum(entity.dimshuffle(0, 'x', 1) * img_sum[img_neg], axis=2)
+        sent_scores += T.sum(entity[sent_neg] * img_sum.dimshuffle(0, 'x', 1), axis=2)
+    margin = 1. - positive.dimshuffle(0, 'x')
+    # a batch of one sample has no j != k to draw
+    rows = T.arange(out_flat.shape[0]).dimshuffle(0, 'x')
+    return T.sum(T.maximum(0, img_scores + margin) * T.neq(img_neg, rows)) + \
+        T.sum(T.maximum(0, sent_scores + margin) * T.neq(sent_neg, rows))
+
+def rcn_sampled_cost_func(nb_negatives=10, mining='uniform', seed=1337, masked=False):
+    '''rcn_cost_func against nb_negatives sampled negatives per positive,
+    mining is 'uniform' or 'hard'. Returns the loss for model.compile.
+    '''
+    if mining not in ('uniform', 'hard'):
+        raise Exception('Invalid negative mining: ' + str(mining))
+    rng = RandomStreams(seed)
+    def cost_func(y_true, y_pred):
+        out_flat, img_flat, lengths = _alignment_operands(y_true, y_pred, masked)
+        return _sampled_hinge_loss(out_flat, img_flat, lengths, nb_negatives=nb_negatives, mining=mining, rng=rng)
+    return cost_func
+
+def crcn_sampled_cost_func(nb_negatives=10, mining='uniform', seed=1337, masked=False):
+    '''crcn_cost_func against nb_negatives sampled negatives per positive,
+    mining is 'uniform' or 'hard'. Returns the loss for model.compile.
+    '''
+    if mining not in ('uniform', 'hard'):
+        raise Exception('Invalid negative mining: ' + str(mining))
+    rng = RandomStreams(seed)
+    def cost_func(y_true, y_pred):
+        out_flat, img_flat, lengths = _alignment_operands(y_true, y_pred[:, :-1], masked)
+        return _sampled_hinge_loss(out_flat, img_flat, lengths, y_pred[:, -1], T.sum(y_true, axis=1),
+                                   nb_negatives, mining, rng)
+    return cost_func
+
 def crcn_cohevec_cost_func(y_true, y_pred):
     # y_pred = (batch nb, vector nb,  dimension)
     # y_true = image vector = (batch nb, vector nb,  dimension)
@@ -180,6 +326,25 @@ def rcn_score_func(y_true, y_pred):
     (sumscores,updates)=theano.scan(fn=iter_k,sequences=[y_pred,y_true])
     return T.sum(sumscores)
 
+def crcn_score_vec_func(y_true, y_pred):
+    # per-sample version of crcn_score_func: returns a (batch nb,) vector
+    # y_pred = (batch nb, vector nb + 1,  dimension), last vector is the entity vector
+    # y_true = image vector = (batch nb, vector nb,  dimension)
+    out_matrix = y_pred[:, :-1]
+    entity = y_pred[:, -1]
+    seq_len = T.minimum(out_matrix.shape[1], y_true.shape[1])
+    # diagonal alignment normalized by its length, as T.eye(out_len,img_len)/T.sum(eye)
+    align_score = T.sum(out_matrix[:, :seq_len] * y_true[:, :seq_len], axis=[1, 2]) / T.cast(seq_len, theano.config.floatX)
+    entity_score = T.sum(entity * T.sum(y_true, axis=1), axis=1)
+    return align_score + entity_score
+
+def rcn_score_vec_func(y_true, y_pred):
+    # per-sample version of rcn_score_func: returns a (batch nb,) vector
+    # y_pred = (batch nb, vector nb,  dimension)
+    # y_true = image vector = (batch nb, vector nb,  dimension)
+    seq_len = T.minimum(y_pred.shape[1], y_true.shape[1])
+    return T.sum(y_pred[:, :seq_len] * y_true[:, :seq_len], axis=[1, 2]) / T.cast(seq_len, theano.config.floatX)
+
 def mean_squared_error(y_true, y_pred):
     return T.sqr(y_pred - y_true).mean()
 
@@ -0,0 +1,185 @@
+import numpy as np
+
+DUPLICATE_THRESHOLD=0.01
+DEFAULT_BLOCK_SIZE=8192
+
+def corpus_norms(features_struct,metric='euclidean'):
+    # squared L2 norms for euclidean, L2 norms for cosine; computed once per corpus
+    sqnorms=np.einsum('ij,ij->i',features_struct,features_struct)
+    if metric=='cosine':
+        return np.sqrt(sqnorms)
+    return sqnorms
+
+class KNNIndex(object):
+    """
+    Exact k nearest neighbour search over the corpus image features.
+
+    A whole image stream is scored against the corpus with one matrix product per
+    corpus block (||q||^2 + ||x||^2 - 2 q.x), so memory stays bounded by
+    len(queries) * block_size whatever the corpus size. The shortlisted rows are
+    re-scored exactly, so the ranking is the same as scipy.spatial.distance.
+    Near duplicates are judged on exact distances only: a row whose blocked
+    distance could be under min_distance within rounding error is re-scored
+    before the shortlist is cut.
+
+    Arguments
+    ---------
+    features_struct: corpus features, (image count, feature dim)
+    metric: 'euclidean' or 'cosine'
+    block_size: number of corpus rows scored at once
+    """
+    def __init__(self,features_struct,metric='euclidean',block_size=DEFAULT_BLOCK_SIZE):
+        if metric not in ('euclidean','cosine'):
+            raise Exception('Invalid metric: '+str(metric))
+        self.features=features_struct
+        self.metric=metric
+        self.block_size=block_size
+        self.norms=corpus_norms(features_struct,metric)
+
+    def __len__(self):
+        return len(self.features)
+
+    def _block_distances(self,queries,query_norms,start,end):
+        dots=np.dot(queries,self.features[start:end].T)
+        if self.metric=='cosine':
+            denom=np.outer(query_norms,self.norms[start:end])
+            denom[denom==0]=1.
+            return 1.-dots/denom
+        dst=query_norms[:,None]+self.norms[None,start:end]-2.*dots
+        np.maximum(dst,0.,out=dst)
+        return np.sqrt(dst)
+
+    def _error_bound(self,query_norms,start,end):
+        # worst case rounding error of a blocked distance, in squared distance for
+        # euclidean (q.q + x.x - 2 q.x cancels) and in distance for cosine
+        eps=np.finfo(self.features.dtype).eps*(self.features.shape[1]+2)
+        if self.metric=='cosine':
+            return eps
+        return eps*(query_norms[:,None]+self.norms[None,start:end])
+
+    def _pair_distances(self,queries,query_rows,rows,chunk_size=4096):
+        # exact distances of queries[query_rows[i]] to corpus row rows[i]
+        dst=np.empty(len(rows))
+        for i in range(0,len(rows),chunk_size):
+            q=queries[query_rows[i:i+chunk_size]]
+            x=self.features[rows[i:i+chunk_size]].astype(np.float64)
+            if self.metric=='cosine':
+                denom=np.sqrt(np.einsum('ij,ij->i',q,q))*self.norms[rows[i:i+chunk_size]]
+                denom[denom==0]=1.
+                dst[i:i+chunk_size]=1.-np.einsum('ij,ij->i',q,x)/denom
+            else:
+                dst[i:i+chunk_size]=np.sqrt(((x-q)**2).sum(axis=1))
+        return dst
+
+    def exact_distances(self,query,rows):
+        # in float64 whatever the store dtype, as scipy.spatial.distance on the .mat features
+        query=np.asarray(query,dtype=np.float64)
+        candidates=self.features[rows].astype(np.float64)
+        if self.metric=='cosine':
+            denom=np.sqrt(np.dot(query,query))*self.norms[rows]
+            denom[denom==0]=1.
+            return 1.-np.dot(candidates,query)/denom
+        return np.sqrt(((candidates-query)**2).sum(axis=1))
+
+    def search(self,queries,k,exclude=None,min_distance=DUPLICATE_THRESHOLD):
+        """
+        Return (indices, distances), both (len(queries), k), sorted by increasing
+        distance with ties broken by corpus index. Rows flagged in `exclude` and
+        rows closer than `min_distance` (near duplicates) are never returned.
+        Missing entries are padded with index -1 and distance inf.
+        """
+        exact_queries=np.atleast_2d(np.asarray(queries,dtype=np.float64))
+        queries=exact_queries.astype(self.features.dtype)
+        nb_queries=len(queries)
+        corpus_len=len(self.features)
+        k=min(k,corpus_len)
+        if self.metric=='cosine':
+            query_norms=np.sqrt(np.einsum('ij,ij->i',queries,queries))
+        else:
+            query_norms=np.einsum('ij,ij->i',queries,queries)
+
+        # keep a little more than k per block so the exact re-scoring can reorder near ties
+        pool=min(corpus_len,k+max(8,k))
+        cand_index=[]
+        cand_dst=[]
+        for start in range(0,corpus_len,self.block_size):
+            end=min(corpus_len,start+self.block_size)
+            dst=self._block_distances(queries,query_norms,start,end)
+            if exclude is not None:
+                dst[:,exclude[start:end]]=np.inf
+            if min_distance is not None:
+                #rows that may be near duplicates are re-scored exactly before filtering,
+                #so rounding of the blocked product never drops a true neighbour
+                if self.metric=='cosine':
+                    suspect=dst<min_distance+self._error_bound(query_norms,start,end)
+                else:
+                    suspect=dst**2<min_distance**2+self._error_bound(query_norms,start,end)
+                query_rows,rows=np.nonzero(suspect)
+                if len(rows):
+                    exact=self._pair_distances(exact_queries,query_rows,rows+start)
+                    dst[query_rows,rows]=np.where(exact<min_distance,np.inf,exact)
+            block_pool=min(pool,end-start)
+            if block_pool<end-start:
+                part=np.argpartition(dst,block_pool-1,axis=1)[:,:block_pool]
+            else:
+                part=np.tile(np.arange(end-start),(nb_queries,1))
+            cand_index.append(part+start)
+            cand_dst.append(dst[np.arange(nb_queries)[:,None],part])
+        cand_index=np.concatenate(cand_index,axis=1)
+        cand_dst=np.concatenate(cand_dst,axis=1)
+
+        indices=np.empty((nb_queries,k),dtype=np.int64)
+        indices.fill(-1)
+        distances=np.empty((nb_queries,k))
+        distances.fill(np.inf)
+        for q in range(nb_queries):
+            rows=cand_index[q][np.isfinite(cand_dst[q])]
+            if len(rows)>pool:
+                rows=rows[np.argpartition(cand_dst[q][np.isfinite(cand_dst[q])],pool-1)[:pool]]
+            if len(rows)==0:
+                continue
+            exact=self.exact_distances(exact_queries[q],rows)
+            keep=np.ones(len(rows),dtype=bool)
+            if min_distance is not None:
+                keep&=exact>=min_distance
+            rows=rows[keep]
+            exact=exact[keep]
+            order=np.lexsort((rows,exact))[:k]
+            indices[q,:len(order)]=rows[order]
+            distances[q,:len(order)]=exact[order]
+        return indices,distances
+
+_knn_index_cache={}
+
+def get_knn_index(features_struct,metric='euclidean',block_size=DEFAULT_BLOCK_SIZE):
+    # corpus norms are computed once per (features array, metric) and reused by every request
+    key=(id(features_struct),metric,block_size)
+    if key in _knn_index_cache and _knn_index_cache[key].features is features_struct:
+        return _knn_index_cache[key]
+    index=KNNIndex(features_struct,metric=metric,block_size=block_size)
+    _knn_index_cache[key]=index
+    return index
+
+def nearest_valid_neighbors(index,queries,k,is_valid,exclude=None,min_distance=DUPLICATE_THRESHOLD,**search_args):
+    """
+    For each query return the k nearest corpus indices accepted by `is_valid`,
+    widening the shortlist when too many of the nearest rows are rejected.
+    `index` is a KNNIndex or anything with the same search() (e.g. IVFPQIndex);
+    extra keyword arguments are passed on to search().
+    """
+    queries=np.atleast_2d(queries)
+    results=[]
+    shortlist=max(k*4,16)
+    indices,_=index.search(queries,shortlist,exclude=exclude,min_distance=min_distance,**search_args)
+    for q in range(len(queries)):
+        row=indices[q]
+        width=shortlist
+        while True:
+            accepted=[i for i in row[row>=0] if is_valid(i)][:k]
+            if len(accepted)==k or width>=len(index) or row[-1]<0:
+                break
+            width=min(len(index),width*4)
+            row,_=index.search(queries[q:q+1],width,exclude=exclude,min_distance=min_distance,**search_args)
+            row=row[0]
+        results.append(accepted)
+    return results
@@ -9,11 +9,17 @@ from keras.layers.normalization import BatchNormalization
 from keras.optimizers import SGD
 from keras.layers.recurrent import *
 
-def create_crcn():
+#options of the create_* functions, all off by default:
+#fused=True builds the same model on FusedBLSTM, which also loads BLSTM checkpoints
+#mask_zero=True treats all-zero sentence vectors as end padding
+#unroll=True builds the recurrence as a static graph of max_length steps
+
+def create_crcn(mask_zero=False,unroll=False,max_length=None):
     model = Sequential()
     model.add(BRNN(
         300, 300, return_sequences=True,init='he_normal',
-        is_entity=True, regularize=False))
+        is_entity=True, regularize=False, mask_zero=mask_zero,
+        unroll=unroll, max_length=max_length))
     model.add(Activation('relu'))
     model.add(Dropout(0.5))
     model.add(Embedding(300, 512,init='he_normal'))
@@ -22,11 +28,12 @@ def create_crcn():
     model.add(Dropout(0.7))
     return model
 
-def create_rcn():
+def create_rcn(mask_zero=False,unroll=False,max_length=None):
     model = Sequential()
     model.add(BRNN(
         300, 300, return_sequences=True,init='he_normal',
-        is_entity=False, regularize=False))
+        is_entity=False, regularize=False, mask_zero=mask_zero,
+        unroll=unroll, max_length=max_length))
     model.add(Activation('relu'))
     model.add(Dropout(0.5))
     model.add(Embedding(300, 512,init='he_normal'))
@@ -35,11 +42,13 @@ def create_rcn():
     model.add(Dropout(0.7))
     return model
 
-def create_crcn_blstm():
+def create_crcn_blstm(fused=False,mask_zero=False,unroll=False,max_length=None):
     model = Sequential()
-    model.add(BLSTM(
+    blstm = FusedBLSTM if fused else BLSTM
+    model.add(blstm(
         300, 300, return_sequences=True,init='he_normal',
-        is_entity=True, regularize=True))
+        is_entity=True, regularize=True, mask_zero=mask_zero,
+        unroll=unroll, max_length=max_length))
     model.add(Activation('relu'))
     model.add(Dropout(0.5))
     model.add(Embedding(300, 512,init='he_normal'))
@@ -48,11 +57,13 @@ def create_crcn_blstm():
     model.add(Dropout(0.7))
     return model
 
-def create_rcn_blstm():
+def create_rcn_blstm(fused=False,mask_zero=False,unroll=False,max_length=None):
     model = Sequential()
-    model.add(BLSTM(
+    blstm = FusedBLSTM if fused else BLSTM
+    model.add(blstm(
         300, 300, return_sequences=True,init='he_normal',
-        is_entity=False, regularize=True))
+        is_entity=False, regularize=True, mask_zero=mask_zero,
+        unroll=unroll, max_length=max_length))
     model.add(Activation('relu'))
     model.add(Dropout(0.5))
     model.add(Embedding(300, 512,init='he_normal'))
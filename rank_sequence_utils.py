@@ -1,54 +1,203 @@
 import sys
 sys.path.append("./keras")
 import theano
+from theano import tensor as T
+from keras.layers.core import Dropout
+from keras.layers.embeddings import Embedding
 from theano import tensor
 import numpy as np
 import pickle
 import json
 import os
 import scipy.io
+import weakref
 from operator import itemgetter
 
-def model_output(sentseq,model):
-    get_activations = theano.function([model.layers[0].input], model.layers[-1].output(train=False), allow_input_downcast=True)
-    return get_activations(sentseq)
+SCORE_BATCH_SIZE=256
+
+_compiled_functions={}
+
+def get_compiled_function(model,name,build):
+    #compiled theano functions are cached per (model identity, name); build() compiles on a miss
+    key=(id(model),name)
+    entry=_compiled_functions.get(key)
+    if entry is None or entry[0]() is not model:
+        entry=(weakref.ref(model),build())
+        _compiled_functions[key]=entry
+    return entry[1]
+
+def get_activation_function(model,train=False):
+    def build():
+        return theano.function([model.layers[0].input], model.layers[-1].output(train=train), allow_input_downcast=True)
+    return get_compiled_function(model,('activations',train),build)
+
+def model_output(sentseq,model,train=False):
+    return get_activation_function(model,train)(sentseq)
+
+def warmup_model(model,seq_len,sent_dim=300,cnn_dim=4096,is_entity=False):
+    #compiles and runs the forward and score functions once on dummy data,
+    #so the first real request does not pay for compilation and first-call allocations
+    #model is a compiled Sequential or one of the scorers below
+    sent_dim=getattr(model,'input_dim',sent_dim)
+    sentseqs=np.zeros((1,seq_len+1 if is_entity else seq_len,sent_dim))
+    imgseqs=np.zeros((1,seq_len,cnn_dim))
+    if isinstance(model,LowRankScorer):
+        model.hidden(sentseqs)
+    elif hasattr(model,'layers'):
+        model_output(sentseqs,model)
+    if hasattr(model,'_score') or not hasattr(model,'layers'):
+        model.score_samples(sentseqs,imgseqs)
+        model.score_query(sentseqs,imgseqs[0])
 
 def model_score(sentseq,imgseq,model):
     return model.test(sentseq, imgseq)
 
-def rank_sequence(sentseqs,imgseqs,keylist,model):
-    score_list={}
-    for i,sentseq in enumerate(sentseqs):
-        sentseq=sentseq.reshape(1,sentseq.shape[0],sentseq.shape[1])
-        imgseq=imgseqs[i]
-        imgseq=imgseq.reshape(1,imgseq.shape[0],imgseq.shape[1])
-        score_list[i]=model_score(sentseq,imgseq,model)
-        #print score_list[i]
-    sorted_list=sorted(score_list.iteritems(), key=itemgetter(1), reverse=True)
-    #[(index,score),..]
-    #print "Small: ",sorted_list[-1]
-    #print "Top: ",sorted_list[0]
-    sorted_key_list=[]
-    for sort_index in sorted_list:
-        index=sort_index[0]
-        sorted_key_list.append(keylist[index])
-    return sorted_key_list
-def rank_sequence_entity(sentseqs,imgseqs,entity_feat,keylist,model):
-    score_list={}
-    for i,sentseq in enumerate(sentseqs):
-        sentseq=sentseq.reshape(1,sentseq.shape[0],sentseq.shape[1])
-        entity=np.pad(entity_feat[i],(0,sentseq.shape[2]-64),'constant', constant_values=0).reshape(1,1,sentseq.shape[2])
-        sentseq=np.concatenate((sentseq,entity),axis=1)
-        imgseq=imgseqs[i]
-        imgseq=imgseq.reshape(1,imgseq.shape[0],imgseq.shape[1])
-        score_list[i]=model_score(sentseq,imgseq,model)
-        #print score_list[i]
-    sorted_list=sorted(score_list.iteritems(), key=itemgetter(1), reverse=True)
+def get_hidden_function(model,layer_index,train=False):
+    def build():
+        return theano.function([model.layers[0].input], model.layers[layer_index].output(train=train), allow_input_downcast=True)
+    return get_compiled_function(model,('hidden',layer_index,train),build)
+
+class LowRankScorer(object):
+    '''
+        Inference scorer that folds the linear head of the model into the query.
+
+        After the nonlinearity at layers[hidden_layer] the RCN/CRCN heads are only
+        Dropout and Embedding layers, i.e. one linear map M (hidden dim, cnn dim).
+        Since the score is a dot product between the model output and the image
+        features, each image of the query is projected once to M.img and every
+        candidate is scored with hidden-dim dot products, skipping the 512/4096-d
+        activations. Exposes score_samples/score_query like a compiled Sequential,
+        so it can be passed to rank_sequence in place of the model.
+    '''
+    def __init__(self,model,hidden_layer=1):
+        self.model=model
+        self.input_dim=model.layers[0].input_dim
+        self.hidden_layer=hidden_layer
+        self.is_entity=getattr(model.layers[0],'is_entity',False)
+        head=None
+        scale=1.
+        for layer in model.layers[hidden_layer+1:]:
+            if isinstance(layer,Dropout):
+                if layer.p>0.:
+                    scale*=1.-layer.p
+            elif isinstance(layer,Embedding):
+                W=layer.W.get_value()
+                head=W if head is None else np.dot(head,W)
+            else:
+                raise Exception('Layer %s after the hidden layer is not linear' % layer.__class__.__name__)
+        self.head=scale*head #(hidden dim, cnn dim)
+
+    def hidden(self,sentseqs):
+        return get_hidden_function(self.model,self.hidden_layer)(sentseqs)
+
+    def project(self,imgseqs):
+        #(..., cnn dim) -> (..., hidden dim)
+        return np.dot(imgseqs,self.head.T)
+
+    def _score(self,hidden,proj):
+        #same formula as crcn_score_vec_func/rcn_score_vec_func on the projected images
+        if self.is_entity:
+            entity=hidden[:,-1]
+            hidden=hidden[:,:-1]
+        seq_len=min(hidden.shape[1],proj.shape[-2])
+        scores=(hidden[:,:seq_len]*proj[...,:seq_len,:]).sum(axis=(1,2))/seq_len
+        if self.is_entity:
+            scores+=(entity*proj.sum(axis=-2)).sum(axis=-1)
+        return scores
+
+    def score_query(self,X,y_seq,batch_size=SCORE_BATCH_SIZE):
+        proj=self.project(y_seq) #once per query
+        scores=np.zeros((len(X),))
+        for batch_start in range(0,len(X),batch_size):
+            batch_end=min(len(X),batch_start+batch_size)
+            scores[batch_start:batch_end]=self._score(self.hidden(X[batch_start:batch_end]),proj)
+        return scores
+
+    def score_samples(self,X,y,batch_size=SCORE_BATCH_SIZE):
+        scores=np.zeros((len(X),))
+        for batch_start in range(0,len(X),batch_size):
+            batch_end=min(len(X),batch_start+batch_size)
+            scores[batch_start:batch_end]=self._score(self.hidden(X[batch_start:batch_end]),self.project(y[batch_start:batch_end]))
+        return scores
+
+class PrecomputedGateScorer(object):
+    '''
+        Scores candidate sequences whose vectors are BLSTM gate projections
+        (rows of a projected DocVecMatrix) instead of doc2vec vectors: the input
+        GEMMs of the first BLSTM layer are skipped and only the recurrence and
+        the head run per candidate. The CRCN entity vector goes in the first
+        columns of the last row, as append_entity already does.
+        Same score_samples/score_query interface as a compiled Sequential.
+    '''
+    def __init__(self,model,score=None):
+        self.model=model
+        self.layer=model.layers[0]
+        self.input_dim=8*self.layer.output_dim
+        if score is None:
+            score=model.score_objective
+        self.score_objective=score
+
+    def _build(self,query):
+        #the layer reads its input as gate projections only while the graph is built
+        layer=self.layer
+        saved_input=layer.input
+        layer.input=T.tensor3()
+        layer.precomputed_input=True
+        try:
+            X=layer.input
+            output=self.model.layers[-1].output(train=False)
+        finally:
+            layer.input=saved_input
+            layer.precomputed_input=False
+        if query:
+            y=T.matrix()
+            score=self.score_objective(y.dimshuffle('x',0,1),output)
+        else:
+            y=T.tensor3()
+            score=self.score_objective(y,output)
+        return theano.function([X,y],score,allow_input_downcast=True)
+
+    def _score(self,X,y,query,batch_size):
+        score_function=get_compiled_function(self.model,('precomputed_score',query),lambda: self._build(query))
+        scores=np.zeros((len(X),))
+        for batch_start in range(0,len(X),batch_size):
+            batch_end=min(len(X),batch_start+batch_size)
+            if query:
+                scores[batch_start:batch_end]=score_function(X[batch_start:batch_end],y)
+            else:
+                scores[batch_start:batch_end]=score_function(X[batch_start:batch_end],y[batch_start:batch_end])
+        return scores
+
+    def score_query(self,X,y_seq,batch_size=SCORE_BATCH_SIZE):
+        return self._score(X,y_seq,True,batch_size)
+
+    def score_samples(self,X,y,batch_size=SCORE_BATCH_SIZE):
+        return self._score(X,y,False,batch_size)
+
+def top_indices(scores,topk=None):
+    #indices of the topk highest scores, best first; ties keep the lower index first
+    index=np.arange(len(scores))
+    if topk is not None and topk<len(scores):
+        index=np.argpartition(-scores,topk-1)[:topk]
+    return index[np.lexsort((index,-scores[index]))]
+
+def rank_sequence(sentseqs,imgseqs,keylist,model,topk=None,batch_size=SCORE_BATCH_SIZE):
+    #scores all candidates in chunks of batch_size with model.score_samples
+    #imgseqs is either one image sequence per candidate (caselen, content_len, 4096)
+    #or a single image sequence (content_len, 4096) shared by every candidate
+    if imgseqs.ndim==2:
+        scores=model.score_query(sentseqs,imgseqs,batch_size=batch_size)
+    else:
+        scores=model.score_samples(sentseqs,imgseqs,batch_size=batch_size)
     #[(index,score),..]
-    #print "Small: ",sorted_list[-1]
-    #print "Top: ",sorted_list[0]
-    sorted_key_list=[]
-    for sort_index in sorted_list:
-        index=sort_index[0]
-        sorted_key_list.append(keylist[index])
-    return sorted_key_list
+    return [keylist[index] for index in top_indices(scores,topk)]
+
+def append_entity(sentseqs,entity_feat):
+    #entity_feat={index:64 dim vector}, appended as the last vector of each sentence sequence
+    entity=np.zeros((len(sentseqs),1,sentseqs.shape[2]))
+    for i in range(len(sentseqs)):
+        entity[i,0,:len(entity_feat[i])]=entity_feat[i]
+    return np.concatenate((sentseqs,entity),axis=1)
+
+def rank_sequence_entity(sentseqs,imgseqs,entity_feat,keylist,model,topk=None,batch_size=SCORE_BATCH_SIZE):
+    return rank_sequence(append_entity(sentseqs,entity_feat),imgseqs,keylist,model,topk,batch_size)
@@ -8,14 +8,32 @@ from gensim import models
 import json
 import os
 import scipy.io
+from feature_store import *
 from load_models import *
+from keras import objectives
 
 MAX_SEQ_LEN= 10
 
 
 # the GRU below returns sequences of max_caption_len vectors of size 256 (our word embedding size)
-model = create_rcn_blstm()
-model.compile(loss='rcn_cost_func', optimizer='rmsprop')
+#off by default, which trains the published models. To opt in set MASKED=True,
+#which skips the zero padding of sequences shorter than MAX_SEQ_LEN in the
+#layer and the loss, and BUCKET_BATCHES=20 (needs MASKED) to batch sequences
+#of similar length so a batch only runs up to its longest sequence.
+#A masked model scores differently, retrain before comparing results.
+MASKED=False
+BUCKET_BATCHES=None
+model = create_rcn_blstm(mask_zero=MASKED)
+#NEGATIVES=None compares every pair of the batch, O(BATCH_SIZE^2) per step;
+#a number samples that many negatives per sequence ('uniform' or 'hard' NEGATIVE_MINING),
+#O(BATCH_SIZE*NEGATIVES), which allows larger batches
+NEGATIVES=None
+NEGATIVE_MINING='uniform'
+BATCH_SIZE=100
+if NEGATIVES is None:
+    model.compile(loss='rcn_masked_cost_func' if MASKED else 'rcn_cost_func', optimizer='rmsprop')
+else:
+    model.compile(loss=objectives.rcn_sampled_cost_func(NEGATIVES,NEGATIVE_MINING,masked=MASKED), optimizer='rmsprop')
 
 # "images" is a numpy array of shape (nb_samples, nb_channels=3, width, height)
 # "captions" is a numpy array of shape (nb_samples, max_caption_len=16, embedding_dim=256)
@@ -33,8 +51,8 @@ json_data=jsonfile.read()
 jsondata=json.loads(json_data)
 json_imgs=jsondata['images']
 
-features_path = os.path.join('./data/', 'example.mat')
-features_struct = scipy.io.loadmat(features_path)['feats'].transpose()
+features_path = resolve_features_path(os.path.join('./data/', 'example.mat'))
+features_struct = load_features(features_path)
 
 contents={}
 
@@ -81,7 +99,8 @@ for i,seq_list in enumerate(data_list):
 
 for i in range(1,20):
     print "Number of stage", i
-    model.fit(Sentenceseq, Imageseq, batch_size=100, nb_epoch=5,validation_split=0.1,shuffle=True)
+    model.fit(Sentenceseq, Imageseq, batch_size=BATCH_SIZE, nb_epoch=5,validation_split=0.1,shuffle=True,
+        bucket_batches=BUCKET_BATCHES if MASKED else None,keep_trailing=0)
     print "Checkpoint saved"
     model.save_weights('./model/rcn_'+str(i)+'.hdf5')
 
@@ -0,0 +1,62 @@
+#checks the blocked nearest neighbour search against the former brute-force scan of topk_utils
+#python test_knn_utils.py
+import unittest
+
+import numpy as np
+from scipy.spatial import distance
+
+from knn_utils import *
+
+def brute_force_neighbors(features,queries,k,is_valid,exclude):
+    # one scipy distance per corpus row, sorted with ties in corpus order,
+    # test rows and near duplicates skipped, as output_list_topk_* used to do
+    results=[]
+    for query in queries:
+        dst=[distance.euclidean(query,feature) for feature in features]
+        accepted=[]
+        for i in sorted(range(len(features)),key=lambda i:dst[i]):
+            if len(accepted)==k:
+                break
+            if exclude[i] or dst[i]<DUPLICATE_THRESHOLD or not is_valid(i):
+                continue
+            accepted.append(i)
+        results.append(accepted)
+    return results
+
+class TestKNNIndex(unittest.TestCase):
+    def setUp(self):
+        rng=np.random.RandomState(1337)
+        # large norms make the cancellation of q.q + x.x - 2 q.x in float32 larger than the threshold
+        self.features=(rng.rand(700,256)*40).astype(np.float32)
+        self.queries=(rng.rand(12,256)*40).astype(np.float32)
+        #near duplicates of every query on both sides of DUPLICATE_THRESHOLD
+        for q in range(len(self.queries)):
+            for j,scale in enumerate([0.,0.2,0.9,1.1,1.5,3.]):
+                direction=rng.randn(256)
+                row=self.queries[q]+direction/np.linalg.norm(direction)*DUPLICATE_THRESHOLD*scale
+                self.features[q*6+j]=row.astype(np.float32)
+        self.valid=rng.rand(len(self.features))>0.3
+        self.exclude=np.zeros(len(self.features),dtype=bool)
+        self.exclude[rng.choice(len(self.features),20,replace=False)]=True
+
+    def test_matches_brute_force(self):
+        features=self.features.astype(np.float64)
+        queries=self.queries.astype(np.float64)
+        is_valid=lambda i:self.valid[i]
+        expected=brute_force_neighbors(features,queries,3,is_valid,self.exclude)
+        for block_size in [64,DEFAULT_BLOCK_SIZE]:
+            index=KNNIndex(self.features,block_size=block_size)
+            found=nearest_valid_neighbors(index,self.queries,3,is_valid,exclude=self.exclude)
+            self.assertEqual(found,expected)
+
+    def test_duplicates_use_exact_distances(self):
+        index=KNNIndex(self.features,block_size=64)
+        indices,distances=index.search(self.queries,8)
+        for q in range(len(self.queries)):
+            exact=[distance.euclidean(self.queries[q].astype(np.float64),self.features[i].astype(np.float64)) for i in range(q*6,q*6+6)]
+            kept=set(indices[q])
+            for j in range(6):
+                self.assertEqual(q*6+j in kept,exact[j]>=DUPLICATE_THRESHOLD,(q,j,exact[j]))
+
+if __name__ == '__main__':
+    unittest.main()
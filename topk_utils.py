@@ -9,10 +9,21 @@ sys.path.append("./keras")
 sys.path.append("./entity")
 
 
-from scipy.spatial import distance
 from operator import itemgetter
 from rank_sequence_utils import *
 from entity_score import *
+from knn_utils import *
+from docvec_utils import *
+from role_columns import *
+import entity_score as entity_score_module
+
+SENT_DIM=300
+CNN_DIM=4096
+SPLIT_VAL=5
+TOPK=3
+SECOND_SELECT_TOP=15
+BRNN_FINAL_SELECT_TOP=5
+BEAM_WIDTH=15
 
 def make_combine_list(combined_list,split_list,count,max_c):
     #input combined_list=[],
@@ -58,282 +69,176 @@ def make_merge_list(merged_list,rank_comb_list,count,max_c):
             new_merged_list.append(newlist)
         return make_merge_list(new_merged_list,rank_comb_list,count+1,max_c)
 
-def output_topk_crcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded):
-    return ' '.join(output_list_topk_crcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded))
-def output_list_topk_crcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded):
-    SENT_DIM=300
-    CNN_DIM=4096
-    SPLIT_VAL=5
-    TOPK=3
-    SECOND_SELECT_TOP=15
-    BRNN_FINAL_SELECT_TOP=5
-
-
-    assert len(json_imgs)==len(features_struct), 'Dataset error: Image count is %d Feature count is %d.' % (len(json_imgs),len(features_struct), )
-    img_match_index_list=[] #[[{"12":23.1},{"144":32},..top k], .. img seq num.. ]
-    dict_dst={}
-    paragraph_list=[]
-    testdata_index_list=[testimg['imgid'] for testimg in testdata]
-    image_seq_features=[testimg['feature'] for testimg in testdata]
-    for seq_feature in image_seq_features:
-        for i,data_feature in enumerate(features_struct):
-            dst = distance.euclidean(seq_feature,data_feature)
-            dict_dst[i]=dst
-            #we considered euclidean not cosine similarity
-        sorted_list=sorted(dict_dst.iteritems(), key=itemgetter(1), reverse=False)
-        #img_match_index_list.append(sorted_list[:TOPK])
-        top_paragraph=[]
-        count=0
-        for dict_top in sorted_list:
-            if count==TOPK:
-                break
-            try:
-                index_match=dict_top[0]
-                if index_match in testdata_index_list or dict_top[1]<0.01: #remove test set in index_match
-                    continue
-                imgid=json_imgs[index_match]['imgid']
-                doc2vecmodel[str(imgid)] #check sentence exits
-                count+=1
-                top_paragraph.append(imgid)
-            except:
-                pass
-        paragraph_list.append(top_paragraph)
-
-    #print paragraph_list
-    #paragraph_list=[[imgid1 imgid2 ..imgidk ], ..seq numb]
+def beam_search_list(paragraph_list,rank_candidates,beam_width):
+    #input paragraph_list=[[imgid1 imgid2 ..imgidk ], ..seq numb]
+    #rank_candidates(key_seq_list,offset,topk) returns the topk of key_seq_list sorted by RCN/CRCN score, best first
+    #output = best beam_width sequences [[imgid1 , ...seq numb], ..], best first
+    #keeps beam_width partial sequences per position, so the cost is linear in the stream length
+    beam_list=[[]]
+    for topk_list in paragraph_list:
+        extended_list=[]
+        for beam in beam_list:
+            for topk in topk_list:
+                newlist=list(beam)
+                newlist.append(topk) #add one
+                extended_list.append(newlist)
+        beam_list=rank_candidates(extended_list,0,beam_width)
+    return beam_list
+
+def cartesian_search_list(paragraph_list,rank_candidates,split_val,second_select_top):
+    #input paragraph_list=[[imgid1 imgid2 ..imgidk ], ..seq numb]
+    #rank_candidates(key_seq_list,offset,topk) returns the topk of key_seq_list sorted by score, best first,
+    #where offset is the position of the first image of the candidates in the stream
     # divide and concat
     #have to change variable split number
-    if len(paragraph_list)>=SPLIT_VAL+1:
-
+    if len(paragraph_list)>=split_val+1:
         rank_comb_list=[]
-        split_num=len(paragraph_list)/SPLIT_VAL
-        if len(paragraph_list)%SPLIT_VAL==0:
+        split_num=len(paragraph_list)/split_val
+        if len(paragraph_list)%split_val==0:
             range_max=split_num
         else:
             range_max=split_num+1
         for sp in range(0,range_max):
             split_list=[]
             if sp==split_num:
-                split_list=paragraph_list[sp*SPLIT_VAL:]
+                split_list=paragraph_list[sp*split_val:]
             else:
-                split_list=paragraph_list[sp*SPLIT_VAL:(sp+1)*SPLIT_VAL]
+                split_list=paragraph_list[sp*split_val:(sp+1)*split_val]
             combined_list=make_combine_list([],split_list,0,len(split_list))
-            caselen=len(combined_list)
-            content_len=len(split_list)
-            sentseqs=np.zeros((caselen, content_len,SENT_DIM))
-            imgseqs=np.zeros((caselen, content_len,CNN_DIM))
-            #vectorize data
-            key_seq_list=[]
-            document_trees=[]
-            for i,imgid_seq in enumerate(combined_list):
-                key_seq=[]
-                document_tree=""
-                for j,imgid in enumerate(imgid_seq):
-
-                    imgseqs[i][j]=image_seq_features[sp*SPLIT_VAL+j]
-                    key_seq.append(imgid)
-                    json_img=json_imgs[imgid]
-                    for sentence in json_img['sentences']:
-                        if sentence['tree'] not in document_tree:
-                            document_tree+=sentence['tree']
-                    sentseqs[i][j]=doc2vecmodel[str(imgid)] #always has paragraph cleaned data
-                key_seq_list.append(key_seq)
-                document_trees.append(document_tree)
-            entity_feat=entity_feature(document_trees)
-
-            rank_comb_list.append(rank_sequence_entity(sentseqs,imgseqs,entity_feat,key_seq_list,model_loaded)[:SECOND_SELECT_TOP])
+            rank_comb_list.append(rank_candidates(combined_list,sp*split_val,second_select_top))
         #rank_comb_list=[[(index,score]..casenum]..range_max]
         #merge Phase
         merged_list=make_merge_list([],rank_comb_list,0,range_max)
-
     else:#for not divided case
         combined_list=make_combine_list([],paragraph_list,0,len(paragraph_list))
-        caselen=len(combined_list)
-        content_len=len(paragraph_list)
-        sentseqs=np.zeros((caselen, content_len,SENT_DIM))
-        imgseqs=np.zeros((caselen, content_len,CNN_DIM))
-        #vectorize data
-        key_seq_list=[]
-        document_trees=[]
-        for i,imgid_seq in enumerate(combined_list):
-            key_seq=[]
-            document_tree=""
-            for j,imgid in enumerate(imgid_seq):
-                key_seq.append(imgid)
-                imgseqs[i][j]=image_seq_features[j]
-                json_img=json_imgs[imgid]
-                for sentence in json_img['sentences']:
-                    if sentence['tree'] not in document_tree:
-                        document_tree+=sentence['tree']
-                sentseqs[i][j]=doc2vecmodel[str(imgid)] #always has paragraph cleaned data
-            key_seq_list.append(key_seq)
-            document_trees.append(document_tree)
-        entity_feat=entity_feature(document_trees)
-        merged_list=rank_sequence_entity(sentseqs,imgseqs,entity_feat,key_seq_list,model_loaded)[:SECOND_SELECT_TOP]
-    del sentseqs
-    del imgseqs
-    caselen=len(merged_list)
-    content_len=len(paragraph_list)
-    sentseqs=np.zeros((caselen, content_len,SENT_DIM))
-    imgseqs=np.zeros((caselen, content_len,CNN_DIM))
-    key_seq_list=[]
+        merged_list=rank_candidates(combined_list,0,second_select_top)
+    return rank_candidates(merged_list,0)
+
+def make_candidate_tensors(key_seq_list,image_seq_features,docvecs,offset=0):
+    #only the sentence sequences vary between candidates; the image sequence
+    #(content_len, 4096) is returned once and broadcast by the scorer
+    #docvecs is a DocVecMatrix; projected ones (DocVecMatrix.project) are wider than SENT_DIM
+    sentseqs=docvecs.take(key_seq_list) #always has paragraph cleaned data
+    content_len=sentseqs.shape[1]
+    imgseq=np.asarray(image_seq_features[offset:offset+content_len])
+    return sentseqs,imgseq
+
+def make_document_trees(key_seq_list,json_imgs):
     document_trees=[]
-    for i,imgid_seq in enumerate(merged_list):
-        key_seq=[]
+    for imgid_seq in key_seq_list:
         document_tree=""
-        for j,imgid in enumerate(imgid_seq):
-            key_seq.append(imgid)
-            imgseqs[i][j]=image_seq_features[j]
+        for imgid in imgid_seq:
             json_img=json_imgs[imgid]
             for sentence in json_img['sentences']:
                 if sentence['tree'] not in document_tree:
                     document_tree+=sentence['tree']
-            sentseqs[i][j]=doc2vecmodel[str(imgid)] #always has paragraph cleaned data
-        key_seq_list.append(key_seq)
         document_trees.append(document_tree)
-    entity_feat=entity_feature(document_trees)
-    final_list=rank_sequence_entity(sentseqs,imgseqs,entity_feat,key_seq_list,model_loaded)
+    return document_trees
 
-    final_list=final_list[:BRNN_FINAL_SELECT_TOP]
+def make_content_list(imgid_seq,json_imgs):
     final_content_list=[]
-    for imgid in final_list[0]:
+    for imgid in imgid_seq:
         sentence_concat=""
         for sentence in json_imgs[imgid]['sentences']:
             ensent=sentence['raw'].encode('ascii','ignore')
             if ensent not in sentence_concat:
                 sentence_concat+=ensent
         final_content_list.append(sentence_concat)
-
     return final_content_list
-def output_topk_rcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded):
-    return ' '.join(output_list_topk_rcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded))
 
-def output_list_topk_rcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded):
-    SENT_DIM=300
-    CNN_DIM=4096
-    SPLIT_VAL=5
-    TOPK=3
-    SECOND_SELECT_TOP=15
-    BRNN_FINAL_SELECT_TOP=5
+def retrieve_paragraph_list(testdata,json_imgs,features_struct,doc2vecmodel,topk,metric='euclidean',ann_index=None,nprobe=None):
+    #output paragraph_list=[[imgid1 imgid2 ..imgidk ], ..seq numb]
+    #ann_index: optional IVFPQIndex over features_struct, nprobe trades recall for latency
+    docvecs=as_docvec_matrix(doc2vecmodel,json_imgs)
+    testdata_index_list=[testimg['imgid'] for testimg in testdata]
+    image_seq_features=np.asarray([testimg['feature'] for testimg in testdata])
+    search_args={}
+    if ann_index is not None:
+        index=ann_index
+        search_args['nprobe']=nprobe
+    else:
+        index=get_knn_index(features_struct,metric)
+    #remove test set in index_match. imgids built by generate_output.py are strings,
+    #so like the former list membership test only integer imgids mask corpus rows
+    exclude=np.zeros(len(features_struct),dtype=bool)
+    for imgid in testdata_index_list:
+        if isinstance(imgid,(int,long,np.integer)) and 0<=imgid<len(exclude):
+            exclude[imgid]=True
+    def has_sentence(index_match):
+        return docvecs.has(json_imgs[index_match]['imgid']) #check sentence exits
+    neighbor_list=nearest_valid_neighbors(index,image_seq_features,topk,has_sentence,exclude=exclude,min_distance=DUPLICATE_THRESHOLD,**search_args)
+    paragraph_list=[]
+    for neighbors in neighbor_list:
+        paragraph_list.append([json_imgs[index_match]['imgid'] for index_match in neighbors])
+    return paragraph_list
+
+def output_topk_crcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded,metric='euclidean',ann_index=None,nprobe=None,search='cartesian',beam_width=BEAM_WIDTH,role_columns=None):
+    return ' '.join(output_list_topk_crcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded,metric,ann_index,nprobe,search,beam_width,role_columns))
+def output_list_topk_crcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded,metric='euclidean',ann_index=None,nprobe=None,search='cartesian',beam_width=BEAM_WIDTH,role_columns=None):
+    #search: 'cartesian' scores every combination per chunk then every merge,
+    #'beam' extends the best beam_width partial sequences one position at a time
+    #role_columns: optional RoleColumnStore of json_imgs, entity features are then
+    #counted from the stored columns instead of grids of the document trees,
+    #incrementally from the prefix of each candidate under beam search
+    assert len(json_imgs)==len(features_struct), 'Dataset error: Image count is %d Feature count is %d.' % (len(json_imgs),len(features_struct), )
+    if role_columns is not None and entity_score_module.grid_backend!='python':
+        #role columns come from the in-process grid builder, they would not match TestGrid features
+        raise Exception('role_columns need grid_backend=\'python\', got '+str(entity_score_module.grid_backend))
+    image_seq_features=[testimg['feature'] for testimg in testdata]
+    docvecs=as_docvec_matrix(doc2vecmodel,json_imgs)
+    paragraph_list=retrieve_paragraph_list(testdata,json_imgs,features_struct,docvecs,TOPK,metric,ann_index,nprobe)
+    #print paragraph_list
+    #paragraph_list=[[imgid1 imgid2 ..imgidk ], ..seq numb]
 
+    if role_columns is not None and search=='beam':
+        #beam candidates extend the candidates of the previous position by one image
+        role_features=PrefixEntityFeatures(role_columns)
+    else:
+        role_features=role_columns
+
+    def rank_candidates(key_seq_list,offset=0,topk=None):
+        sentseqs,imgseq=make_candidate_tensors(key_seq_list,image_seq_features,docvecs,offset)
+        if role_features is not None:
+            entity_feat=role_features.entity_feature(key_seq_list)
+        else:
+            #the ordered imgid tuple identifies the document within this corpus
+            entity_feat=entity_feature(make_document_trees(key_seq_list,json_imgs),[tuple(imgid_seq) for imgid_seq in key_seq_list])
+        return rank_sequence_entity(sentseqs,imgseq,entity_feat,key_seq_list,model_loaded,topk)
+
+    if search=='beam':
+        final_list=beam_search_list(paragraph_list,rank_candidates,beam_width)
+    elif search=='cartesian':
+        final_list=cartesian_search_list(paragraph_list,rank_candidates,SPLIT_VAL,SECOND_SELECT_TOP)
+    else:
+        raise Exception('Invalid search: '+str(search))
 
+    final_list=final_list[:BRNN_FINAL_SELECT_TOP]
+    return make_content_list(final_list[0],json_imgs)
+def output_topk_rcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded,metric='euclidean',ann_index=None,nprobe=None,search='cartesian',beam_width=BEAM_WIDTH):
+    return ' '.join(output_list_topk_rcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded,metric,ann_index,nprobe,search,beam_width))
+
+def output_list_topk_rcn(testdata,json_imgs,features_struct,doc2vecmodel,model_loaded,metric='euclidean',ann_index=None,nprobe=None,search='cartesian',beam_width=BEAM_WIDTH):
     assert len(json_imgs)==len(features_struct), 'Dataset error: Image count is %d Feature count is %d.' % (len(json_imgs),len(features_struct), )
-    img_match_index_list=[] #[[{"12":23.1},{"144":32},..top k], .. img seq num.. ]
-    dict_dst={}
-    paragraph_list=[]
-    testdata_index_list=[testimg['imgid'] for testimg in testdata]
     image_seq_features=[testimg['feature'] for testimg in testdata]
+    docvecs=as_docvec_matrix(doc2vecmodel,json_imgs)
     # This code can cover TOPK not only TOPK=1
-    for seq_feature in image_seq_features:
-        for i,data_feature in enumerate(features_struct):
-            dst = distance.euclidean(seq_feature,data_feature)
-            dict_dst[i]=dst
-            #we have to consider cosine similarity not euclidean
-        sorted_list=sorted(dict_dst.iteritems(), key=itemgetter(1), reverse=False)
-        #img_match_index_list.append(sorted_list[:TOPK])
-        top_paragraph=[]
-        count=0
-        for dict_top in sorted_list:
-            if count==TOPK:
-                break
-            try:
-                index_match=dict_top[0]
-                if index_match in testdata_index_list or dict_top[1]<0.01: #remove test set in index_match
-                    continue
-                imgid=json_imgs[index_match]['imgid']
-                doc2vecmodel[str(imgid)] #check sentence exits
-                count+=1
-                top_paragraph.append(imgid)
-            except:
-                pass
-        paragraph_list.append(top_paragraph)
-
+    paragraph_list=retrieve_paragraph_list(testdata,json_imgs,features_struct,docvecs,TOPK,metric,ann_index,nprobe)
     #print paragraph_list
 
     #paragraph_list=[[imgid1 imgid2 ..imgidk ], ..seq numb]
 
-    # divide and concat
-    #have to change variable split number
-    if len(paragraph_list)>=SPLIT_VAL+1:
+    def rank_candidates(key_seq_list,offset=0,topk=None):
+        sentseqs,imgseq=make_candidate_tensors(key_seq_list,image_seq_features,docvecs,offset)
+        return rank_sequence(sentseqs,imgseq,key_seq_list,model_loaded,topk)
 
-        rank_comb_list=[]
-        split_num=len(paragraph_list)/SPLIT_VAL
-        if len(paragraph_list)%SPLIT_VAL==0:
-            range_max=split_num
-        else:
-            range_max=split_num+1
-        for sp in range(0,range_max):
-            split_list=[]
-            if sp==split_num:
-                split_list=paragraph_list[sp*SPLIT_VAL:]
-            else:
-                split_list=paragraph_list[sp*SPLIT_VAL:(sp+1)*SPLIT_VAL]
-            combined_list=make_combine_list([],split_list,0,len(split_list))
-            caselen=len(combined_list)
-            content_len=len(split_list)
-            sentseqs=np.zeros((caselen, content_len,SENT_DIM))
-            imgseqs=np.zeros((caselen, content_len,CNN_DIM))
-            #vectorize data
-            key_seq_list=[]
-            for i,imgid_seq in enumerate(combined_list):
-                key_seq=[]
-                for j,imgid in enumerate(imgid_seq):
-                    if type(imgid)!=tuple:
-                        imgseqs[i][j]=image_seq_features[sp*SPLIT_VAL+j]
-                        key_seq.append(imgid)
-                        sentseqs[i][j]=doc2vecmodel[str(imgid)] #always has paragraph cleaned data
-                    else:
-                        print "error"
-                key_seq_list.append(key_seq)
-            #print len(sentseqs)
-            rank_comb_list.append(rank_sequence(sentseqs,imgseqs,key_seq_list,model_loaded)[:SECOND_SELECT_TOP])
-        #rank_comb_list=[[(index,score]..casenum]..range_max]
-        #merge Phase
-        merged_list=make_merge_list([],rank_comb_list,0,range_max)
-    else:#for not divide case
-        combined_list=make_combine_list([],paragraph_list,0,len(paragraph_list))
-        caselen=len(combined_list)
-        content_len=len(paragraph_list)
-        sentseqs=np.zeros((caselen, content_len,SENT_DIM))
-        imgseqs=np.zeros((caselen, content_len,CNN_DIM))
-        #vectorize data
-        key_seq_list=[]
-        for i,imgid_seq in enumerate(combined_list):
-            key_seq=[]
-            for j,imgid in enumerate(imgid_seq):
-                key_seq.append(imgid)
-                imgseqs[i][j]=image_seq_features[j]
-                sentseqs[i][j]=doc2vecmodel[str(imgid)] #always has paragraph cleaned data
-            key_seq_list.append(key_seq)
-        merged_list=rank_sequence(sentseqs,imgseqs,key_seq_list,model_loaded)[:SECOND_SELECT_TOP]
-    del sentseqs
-    del imgseqs
-
-    caselen=len(merged_list)
-    content_len=len(paragraph_list)
-    sentseqs=np.zeros((caselen, content_len,SENT_DIM))
-    imgseqs=np.zeros((caselen, content_len,CNN_DIM))
-    key_seq_list=[]
-    for i,imgid_seq in enumerate(merged_list):
-        key_seq=[]
-        for j,imgid in enumerate(imgid_seq):
-            key_seq.append(imgid)
-            imgseqs[i][j]=image_seq_features[j]
-            sentseqs[i][j]=doc2vecmodel[str(imgid)] #always has paragraph cleaned data
-        key_seq_list.append(key_seq)
-    final_list=rank_sequence(sentseqs,imgseqs,key_seq_list,model_loaded)
+    if search=='beam':
+        final_list=beam_search_list(paragraph_list,rank_candidates,beam_width)
+    elif search=='cartesian':
+        final_list=cartesian_search_list(paragraph_list,rank_candidates,SPLIT_VAL,SECOND_SELECT_TOP)
+    else:
+        raise Exception('Invalid search: '+str(search))
 
     final_list=final_list[:BRNN_FINAL_SELECT_TOP]
     #print final_list
     # final_list is senseq list [[imgid1.., imgidend]..,.. FINAL_SELECT_TOP]
-    final_content_list=[]
-    for imgid in final_list[0]:
-        sentence_concat=""
-        for sentence in json_imgs[imgid]['sentences']:
-            ensent=sentence['raw'].encode('ascii','ignore')
-            if ensent not in sentence_concat:
-                sentence_concat+=ensent
-        final_content_list.append(sentence_concat)
-
-    return final_content_list
-
+    return make_content_list(final_list[0],json_imgs)